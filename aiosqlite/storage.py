@@ -1,9 +1,16 @@
+import asyncio
 import base64
 import logging
+import os
+import sqlite3
 import struct
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
-from typing import Any, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from pyrogram import Client, raw, utils
 from pyrogram.storage import Storage
@@ -39,10 +46,11 @@ CREATE TABLE peers
 
 CREATE TABLE usernames
 (
-    id       INTEGER,
-    username TEXT,
+    id       INTEGER NOT NULL,
+    username TEXT    NOT NULL,
+    PRIMARY KEY (id, username),
     FOREIGN KEY (id) REFERENCES peers(id)
-);
+) WITHOUT ROWID;
 
 CREATE TABLE update_state
 (
@@ -58,34 +66,24 @@ CREATE TABLE version
     number INTEGER PRIMARY KEY
 );
 
-CREATE INDEX idx_peers_id ON peers (id);
 CREATE INDEX idx_peers_phone_number ON peers (phone_number);
-CREATE INDEX idx_usernames_id ON usernames (id);
-CREATE INDEX idx_usernames_username ON usernames (username);
-
-CREATE TRIGGER trg_peers_last_update_on
-    AFTER UPDATE
-    ON peers
-BEGIN
-    UPDATE peers
-    SET last_update_on = CAST(STRFTIME('%s', 'now') AS INTEGER)
-    WHERE id = NEW.id;
-END;
+CREATE INDEX idx_peers_last_update_on ON peers (last_update_on);
+CREATE INDEX idx_usernames_username ON usernames (username, id);
 """
 
 USERNAMES_SCHEMA = """
-CREATE TABLE usernames
+CREATE TABLE IF NOT EXISTS usernames
 (
     id       INTEGER,
     username TEXT,
     FOREIGN KEY (id) REFERENCES peers(id)
 );
 
-CREATE INDEX idx_usernames_username ON usernames (username);
+CREATE INDEX IF NOT EXISTS idx_usernames_username ON usernames (username);
 """
 
 UPDATE_STATE_SCHEMA = """
-CREATE TABLE update_state
+CREATE TABLE IF NOT EXISTS update_state
 (
     id   INTEGER PRIMARY KEY,
     pts  INTEGER,
@@ -95,6 +93,72 @@ CREATE TABLE update_state
 );
 """
 
+# language=SQLite
+SCHEMA_V8 = """
+DROP INDEX IF EXISTS idx_peers_id;
+
+-- The trigger would stamp every rewritten peer with the current time and revive expired usernames
+DROP TRIGGER IF EXISTS trg_peers_last_update_on;
+
+UPDATE peers
+SET type = CASE type
+    WHEN 'user' THEN 0
+    WHEN 'bot' THEN 1
+    WHEN 'group' THEN 2
+    WHEN 'channel' THEN 3
+    WHEN 'supergroup' THEN 4
+    WHEN 'forum' THEN 5
+    WHEN 'direct' THEN 6
+    ELSE type
+END;
+
+CREATE TABLE IF NOT EXISTS usernames_v8
+(
+    id       INTEGER NOT NULL,
+    username TEXT    NOT NULL,
+    PRIMARY KEY (id, username),
+    FOREIGN KEY (id) REFERENCES peers(id)
+) WITHOUT ROWID;
+
+INSERT OR IGNORE INTO usernames_v8 (id, username)
+SELECT id, username FROM usernames WHERE id IS NOT NULL AND username IS NOT NULL;
+
+DROP TABLE IF EXISTS usernames;
+
+ALTER TABLE usernames_v8 RENAME TO usernames;
+
+CREATE INDEX IF NOT EXISTS idx_usernames_username ON usernames (username, id);
+"""
+
+# Upgrades from v7 drop the trigger in v8 already, before peers are rewritten. Files created at v8 still have it.
+# language=SQLite
+SCHEMA_V9 = """
+DROP TRIGGER IF EXISTS trg_peers_last_update_on;
+"""
+
+# language=SQLite
+SCHEMA_V10 = """
+CREATE INDEX IF NOT EXISTS idx_peers_last_update_on ON peers (last_update_on);
+"""
+
+PEER_TYPES = {
+    "user": 0,
+    "bot": 1,
+    "group": 2,
+    "channel": 3,
+    "supergroup": 4,
+    "forum": 5,
+    "direct": 6
+}
+
+PEER_TYPE_NAMES = {value: name for name, value in PEER_TYPES.items()}
+
+SQLITE_BUSY = 5
+SQLITE_LOCKED = 6
+
+# SQLite binds up to 32766 parameters per statement since 3.32.0, and 999 before
+MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
 TEST = {
     1: "149.154.175.10",
     2: "149.154.167.40",
@@ -110,6 +174,32 @@ PROD = {
     203: "91.105.192.100"
 }
 
+PROFILES = {
+    "durable": {
+        "synchronous": "FULL",
+        "cache_size": -2000,
+        "temp_store": "DEFAULT",
+        "busy_timeout": 5000,
+        "wal_autocheckpoint": 1000,
+    },
+    "balanced": {
+        "synchronous": "NORMAL",
+        "cache_size": -8000,
+        "mmap_size": 64 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+        "wal_autocheckpoint": 1000,
+    },
+    "throughput": {
+        "synchronous": "OFF",
+        "cache_size": -32000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+        "wal_autocheckpoint": 10000,
+    },
+}
+
 def get_input_peer(peer_id: int, access_hash: int, peer_type: str):
     if peer_type in ["user", "bot"]:
         return raw.types.InputPeerUser(
@@ -131,78 +221,432 @@ def get_input_peer(peer_id: int, access_hash: int, peer_type: str):
     raise ValueError(f"Invalid peer type: {peer_type}")
 
 
+class SnapshotBusy(Exception):
+    pass
+
+
+def abort_if_busy(status: int, remaining: int, total: int):
+    # sqlite3 retries a busy backup step forever, which never ends while this connection has a write open
+    if status in (SQLITE_BUSY, SQLITE_LOCKED):
+        raise SnapshotBusy
+
+
+def decode_peer(peer_id: int, access_hash: int, peer_type: Any, phone_number: str, last_update_on: int):
+    return peer_id, access_hash, PEER_TYPE_NAMES.get(peer_type, peer_type), phone_number, last_update_on
+
+
+class PeerCache:
+    def __init__(self, size: int, ttl: Optional[float] = None):
+        self.size = size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        # id -> (expires_at, (id, access_hash, type, phone_number, last_update_on))
+        self._peers = OrderedDict()
+        self._usernames = {}
+        self._phone_numbers = {}
+        self._peer_usernames = {}
+
+    def __len__(self):
+        return len(self._peers)
+
+    def _lookup(self, peer_id: int):
+        entry = self._peers.get(peer_id)
+
+        if entry is None:
+            return None
+
+        expires_at, peer = entry
+
+        if expires_at is not None and expires_at < time.monotonic():
+            self.discard(peer_id)
+            return None
+
+        self._peers.move_to_end(peer_id)
+
+        return peer
+
+    def _count(self, peer):
+        if peer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return peer
+
+    def get_by_id(self, peer_id: int):
+        return self._count(self._lookup(peer_id))
+
+    def get_by_username(self, username: str):
+        peer_id = self._usernames.get(username)
+
+        return self._count(None if peer_id is None else self._lookup(peer_id))
+
+    def get_by_phone_number(self, phone_number: str):
+        peer_id = self._phone_numbers.get(phone_number)
+        peer = None if peer_id is None else self._lookup(peer_id)
+
+        if peer is not None and peer[3] != phone_number:
+            peer = None
+
+        return self._count(peer)
+
+    def put(self, peer_id: int, access_hash: int, peer_type: str, phone_number: str, last_update_on: int):
+        entry = self._peers.pop(peer_id, None)
+
+        if entry is not None:
+            old_phone_number = entry[1][3]
+
+            if old_phone_number != phone_number and self._phone_numbers.get(old_phone_number) == peer_id:
+                del self._phone_numbers[old_phone_number]
+
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+
+        self._peers[peer_id] = (expires_at, (peer_id, access_hash, peer_type, phone_number, last_update_on))
+
+        if phone_number:
+            self._phone_numbers[phone_number] = peer_id
+
+        while len(self._peers) > self.size:
+            self.discard(next(iter(self._peers)))
+
+    def put_usernames(self, peer_id: int, usernames: List[str]):
+        self._drop_usernames(peer_id)
+
+        if peer_id not in self._peers:
+            return
+
+        for username in usernames:
+            self._usernames[username] = peer_id
+
+        self._peer_usernames[peer_id] = set(usernames)
+
+    def add_username(self, peer_id: int, username: str):
+        if peer_id not in self._peers:
+            return
+
+        self._usernames[username] = peer_id
+        self._peer_usernames.setdefault(peer_id, set()).add(username)
+
+    def _drop_usernames(self, peer_id: int):
+        for username in self._peer_usernames.pop(peer_id, ()):
+            if self._usernames.get(username) == peer_id:
+                del self._usernames[username]
+
+    def discard(self, peer_id: int):
+        entry = self._peers.pop(peer_id, None)
+
+        if entry is None:
+            return
+
+        phone_number = entry[1][3]
+
+        if self._phone_numbers.get(phone_number) == peer_id:
+            del self._phone_numbers[phone_number]
+
+        self._drop_usernames(peer_id)
+
+    def clear(self):
+        self._peers.clear()
+        self._usernames.clear()
+        self._phone_numbers.clear()
+        self._peer_usernames.clear()
+
+
+class SharedCursor:
+    def __init__(self, connection: "SharedConnection", cursor: sqlite3.Cursor):
+        self.connection = connection
+        self._cursor = cursor
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    async def fetchone(self):
+        return await self.connection.run(self._cursor.fetchone)
+
+    async def fetchall(self):
+        return await self.connection.run(self._cursor.fetchall)
+
+    async def fetchmany(self, size: int = None):
+        return await self.connection.run(self._cursor.fetchmany, size or self._cursor.arraysize)
+
+    async def close(self):
+        await self.connection.run(self._cursor.close)
+
+
+class SharedConnection:
+    def __init__(self, executor: "SQLiteExecutor", worker: ThreadPoolExecutor, conn: sqlite3.Connection):
+        self.executor = executor
+        self.worker = worker
+        self._conn = conn
+
+    async def run(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.worker, partial(function, *args, **kwargs))
+
+    async def execute(self, sql: str, parameters=()):
+        return SharedCursor(self, await self.run(self._conn.execute, sql, parameters))
+
+    async def executemany(self, sql: str, parameters):
+        return SharedCursor(self, await self.run(self._conn.executemany, sql, parameters))
+
+    async def executescript(self, sql_script: str):
+        return SharedCursor(self, await self.run(self._conn.executescript, sql_script))
+
+    async def commit(self):
+        await self.run(self._conn.commit)
+
+    async def rollback(self):
+        await self.run(self._conn.rollback)
+
+    async def set_trace_callback(self, handler):
+        await self.run(self._conn.set_trace_callback, handler)
+
+    async def set_progress_handler(self, handler, n: int):
+        await self.run(self._conn.set_progress_handler, handler, n)
+
+    async def backup(self, target, **kwargs):
+        if isinstance(target, SharedConnection):
+            target = target._conn
+
+        await self.run(self._conn.backup, target, **kwargs)
+
+    async def close(self):
+        try:
+            await self.run(self._conn.close)
+        finally:
+            self.executor.release(self.worker)
+
+    @property
+    def in_transaction(self):
+        return self._conn.in_transaction
+
+
+class SQLiteExecutor:
+    def __init__(self, workers: int = 4):
+        self.workers = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sqlite-{i}")
+            for i in range(workers)
+        ]
+        self.connections = {worker: 0 for worker in self.workers}
+
+    async def connect(self, database: str, **kwargs) -> SharedConnection:
+        # Every connection is pinned to one single-threaded worker, which keeps its statements in order
+        worker = min(self.workers, key=self.connections.get)
+        self.connections[worker] += 1
+
+        try:
+            conn = await asyncio.get_running_loop().run_in_executor(
+                worker, partial(sqlite3.connect, database, check_same_thread=False, **kwargs)
+            )
+        except BaseException:
+            self.release(worker)
+            raise
+
+        return SharedConnection(self, worker, conn)
+
+    def release(self, worker: ThreadPoolExecutor):
+        self.connections[worker] -= 1
+
+    def shutdown(self, wait: bool = True):
+        for worker in self.workers:
+            worker.shutdown(wait=wait)
+
+
 class AIOSQLiteStorage(Storage):
-    VERSION = 7
+    VERSION = 10
     USERNAME_TTL = 8 * 60 * 60
     FILE_EXTENSION = ".session"
+    INCREMENTAL_VACUUM_PAGES = 1024
+    QUERY_CHUNK_SIZE = MAX_VARIABLES
+    PRUNE_BATCH_SIZE = 500
+    SNAPSHOT_PAGES = 256
+    SNAPSHOT_ATTEMPTS = 5
 
     def __init__(
         self,
         client: Client,
         use_wal: Optional[bool] = False,
+        auto_vacuum: Optional[bool] = False,
+        vacuum_threshold: Optional[float] = 0.25,
+        maintenance_interval: Optional[float] = 60 * 60,
+        profile: Optional[str] = None,
+        pragmas: Optional[Dict[str, Any]] = None,
+        peer_cache_size: Optional[int] = None,
+        peer_cache_ttl: Optional[float] = None,
+        write_behind: Optional[bool] = False,
+        write_behind_size: Optional[int] = 1000,
+        write_behind_interval: Optional[float] = 1.0,
+        peers_max_count: Optional[int] = None,
+        peers_max_age: Optional[float] = None,
+        executor: Optional[SQLiteExecutor] = None,
+        readers: Optional[int] = 0,
+        snapshot_path: Optional[Union[str, Path]] = None,
+        snapshot_interval: Optional[float] = 5 * 60,
+        state_flush_interval: Optional[float] = None,
+        trace_threshold: Optional[float] = None,
     ):
         super().__init__(client.name)
 
-        self.conn = None  # type: aiosqlite.Connection
+        self.conn = None  # type: Union[aiosqlite.Connection, SharedConnection]
+        self.executor = executor
+        self.readers = []  # type: List[Union[aiosqlite.Connection, SharedConnection]]
+        self._readers_count = readers
+        self._next_reader = 0
+        self._write_generation = 0
+        self._commit_generation = 0
+        self._session = None  # type: Optional[dict]
+        self._batch_lock = asyncio.Lock()
+        self._batch_task = None  # type: Optional[asyncio.Task]
 
         self.session_string = client.session_string
         self.in_memory = client.in_memory
         self.use_wal = use_wal
 
+        if readers and not use_wal:
+            raise ValueError("Reader connections require use_wal=True")
+
+        self.auto_vacuum = auto_vacuum
+        self.vacuum_threshold = vacuum_threshold
+        self.maintenance_interval = maintenance_interval
+        self.peers_max_count = peers_max_count
+        self.peers_max_age = peers_max_age
+
+        if profile is not None and profile not in PROFILES:
+            raise ValueError(f"Invalid profile: {profile}")
+
+        self.pragmas = {**PROFILES.get(profile, {}), **(pragmas or {})}
+
+        self.maintenance_task = None  # type: Optional[asyncio.Task]
+
+        self.peer_cache = PeerCache(peer_cache_size, peer_cache_ttl) if peer_cache_size else None
+
+        self.write_behind = write_behind
+        self.write_behind_size = write_behind_size
+        self.write_behind_interval = write_behind_interval
+        self.write_behind_task = None  # type: Optional[asyncio.Task]
+
+        self._pending_peers = {}  # type: Dict[int, Tuple[int, int, str, str]]
+        self._pending_phone_numbers = {}  # type: Dict[str, int]
+        self._pending_usernames = {}  # type: Dict[int, List[str]]
+        self._pending_username_ids = {}  # type: Dict[str, int]
+
+        if snapshot_path is not None and not self.in_memory:
+            raise ValueError("Snapshots are only supported for in-memory sessions")
+
+        self.snapshot_path = Path(snapshot_path) if snapshot_path is not None else None
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_task = None  # type: Optional[asyncio.Task]
+
+        self.state_flush_interval = state_flush_interval
+        self.state_task = None  # type: Optional[asyncio.Task]
+
+        self._states = None  # type: Optional[Dict[int, Tuple[int, int, int, int, int]]]
+        self._pending_states = {}  # type: Dict[int, Optional[Tuple[int, int, int, int, int]]]
+
         if self.in_memory:
             self.database = ":memory:"
         else:
             self.database = client.workdir / (client.name + self.FILE_EXTENSION)
 
+        self.tracer = None  # type: Optional["SQLTracer"]
+
+        if trace_threshold is not None:
+            # sqltrace.py has to be copied next to this file, see sqltrace/README.md
+            from sqltrace import SQLTracer
+
+            self.tracer = SQLTracer(trace_threshold, None if self.in_memory else str(self.database))
+
     async def update(self):
-        version = await self.version()
+        async with self.batch():
+            # Every step runs in this one transaction, a failed upgrade leaves the file at its old version
+            await self.conn.execute("BEGIN")
 
-        if version == 1:
-            await self.conn.execute("DELETE FROM peers;")
+            version = await self.version()
 
-            version += 1
+            if version == 1:
+                await self.conn.execute("DELETE FROM peers;")
 
-        if version == 2:
-            await self.conn.execute("ALTER TABLE sessions ADD api_id INTEGER;")
+                version += 1
 
-            version += 1
+            if version == 2:
+                await self.conn.execute("ALTER TABLE sessions ADD api_id INTEGER;")
 
-        if version == 3:
-            await self.conn.executescript(USERNAMES_SCHEMA)
+                version += 1
 
-            version += 1
+            if version == 3:
+                await self._execute_script(USERNAMES_SCHEMA)
 
-        if version == 4:
-            await self.conn.executescript(UPDATE_STATE_SCHEMA)
+                version += 1
 
-            version += 1
+            if version == 4:
+                await self._execute_script(UPDATE_STATE_SCHEMA)
 
-        if version == 5:
-            await self.conn.execute("CREATE INDEX idx_usernames_id ON usernames (id);")
+                version += 1
 
-            version += 1
+            if version == 5:
+                await self.conn.execute("CREATE INDEX IF NOT EXISTS idx_usernames_id ON usernames (id);")
 
-        if version == 6:
-            if await self.test_mode():
-                address = TEST[await self.dc_id()]
-                port = 80
-            else:
-                address = PROD[await self.dc_id()]
-                port = 443
+                version += 1
 
-            await self.conn.execute("ALTER TABLE sessions ADD server_address TEXT;")
-            await self.conn.execute("ALTER TABLE sessions ADD port INTEGER;")
+            if version == 6:
+                if await self.test_mode():
+                    address = TEST[await self.dc_id()]
+                    port = 80
+                else:
+                    address = PROD[await self.dc_id()]
+                    port = 443
 
-            await self.conn.execute("UPDATE sessions SET server_address = ?;", (address,))
-            await self.conn.execute("UPDATE sessions SET port = ?;", (port,))
+                await self.conn.execute("ALTER TABLE sessions ADD server_address TEXT;")
+                await self.conn.execute("ALTER TABLE sessions ADD port INTEGER;")
 
-            version += 1
+                await self.conn.execute("UPDATE sessions SET server_address = ?;", (address,))
+                await self.conn.execute("UPDATE sessions SET port = ?;", (port,))
 
-        await self.version(version)
+                version += 1
 
-        await self.conn.commit()
+            if version == 7:
+                await self._execute_script(SCHEMA_V8)
+
+                version += 1
+
+            if version == 8:
+                await self._execute_script(SCHEMA_V9)
+
+                version += 1
+
+            if version == 9:
+                await self._execute_script(SCHEMA_V10)
+
+                version += 1
+
+            await self.version(version)
+
+    async def _execute_script(self, script: str):
+        # executescript() commits first and runs every statement in autocommit, so it can't be rolled back
+        statement = ""
+
+        for line in script.splitlines(keepends=True):
+            statement += line
+
+            if sqlite3.complete_statement(statement):
+                await self.conn.execute(statement)
+                statement = ""
 
     async def create(self):
+        if self.auto_vacuum:
+            await self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
         await self.conn.executescript(SCHEMA)
 
         await self.conn.execute("INSERT INTO version VALUES (?)", (self.VERSION,))
@@ -212,110 +656,631 @@ class AIOSQLiteStorage(Storage):
             (2, "149.154.167.51", 443, None, None, None, 0, None, None),
         )
 
+        await self._commit()
+
+    async def load_session(self):
+        r = await self.conn.execute("SELECT * FROM sessions")
+        row = await r.fetchone()
+
+        self._session = dict(zip([column[0] for column in r.description], row))
+
+    async def load_states(self):
+        r = await self.conn.execute("SELECT id, pts, qts, date, seq FROM update_state")
+
+        self._states = {row[0]: tuple(row) for row in await r.fetchall()}
+
+    def start_state_writer(self):
+        if self.state_flush_interval is not None:
+            self.state_task = asyncio.create_task(self.state_worker())
+
+    async def apply_pragmas(self, conn=None):
+        for name, value in self.pragmas.items():
+            await (conn or self.conn).execute(f"PRAGMA {name}={value}")
+
+    async def connect(self, database: str, **kwargs):
+        if self.executor is not None:
+            conn = await self.executor.connect(database, timeout=1, **kwargs)
+        else:
+            conn = await aiosqlite.connect(database, timeout=1, check_same_thread=False, **kwargs)
+
+        if self.tracer is not None:
+            await self.tracer.attach_async(conn)
+
+        return conn
+
+    async def _commit(self):
+        generation = self._write_generation
+
         await self.conn.commit()
 
+        self._commit_generation = generation
+
+    async def _rollback(self):
+        generation = self._write_generation
+
+        await self.conn.rollback()
+
+        self._commit_generation = generation
+
+    def _reader(self):
+        # Uncommitted writes are only visible to the writer connection
+        if not self.readers or self._write_generation != self._commit_generation:
+            return self.conn
+
+        self._next_reader = (self._next_reader + 1) % len(self.readers)
+
+        return self.readers[self._next_reader]
+
     async def open(self):
         if self.in_memory:
-            self.conn = await aiosqlite.connect(":memory:", timeout=1, check_same_thread=False)
-            await self.create()
+            self.conn = await self.connect(":memory:")
+            await self.apply_pragmas()
+
+            if self.snapshot_path is not None and self.snapshot_path.is_file():
+                await self.restore()
+                await self.update()
+            else:
+                await self.create()
+
+            await self.load_session()
+
+            if self.state_flush_interval is not None:
+                await self.load_states()
+
+            self.start_write_behind()
+            self.start_state_writer()
+
+            if self.snapshot_path is not None and self.snapshot_interval is not None:
+                self.snapshot_task = asyncio.create_task(self.snapshot_worker())
 
             if self.session_string:
-                # Old format
-                if len(self.session_string) in [
-                    self.SESSION_STRING_SIZE,
-                    self.SESSION_STRING_SIZE_64,
-                ]:
-                    dc_id, test_mode, auth_key, user_id, is_bot = struct.unpack(
-                        (
-                            self.OLD_SESSION_STRING_FORMAT
-                            if len(self.session_string) == self.SESSION_STRING_SIZE
-                            else self.OLD_SESSION_STRING_FORMAT_64
-                        ),
+                async with self.batch():
+                    # Old format
+                    if len(self.session_string) in [
+                        self.SESSION_STRING_SIZE,
+                        self.SESSION_STRING_SIZE_64,
+                    ]:
+                        dc_id, test_mode, auth_key, user_id, is_bot = struct.unpack(
+                            (
+                                self.OLD_SESSION_STRING_FORMAT
+                                if len(self.session_string) == self.SESSION_STRING_SIZE
+                                else self.OLD_SESSION_STRING_FORMAT_64
+                            ),
+                            base64.urlsafe_b64decode(
+                                self.session_string + "=" * (-len(self.session_string) % 4)
+                            ),
+                        )
+
+                        await self.dc_id(dc_id)
+                        await self.test_mode(test_mode)
+                        await self.auth_key(auth_key)
+                        await self.user_id(user_id)
+                        await self.is_bot(is_bot)
+                        await self.date(0)
+
+                        log.warning(
+                            "You are using an old session string format. Use export_session_string to update"
+                        )
+                        return
+
+                    dc_id, api_id, test_mode, auth_key, user_id, is_bot = struct.unpack(
+                        self.SESSION_STRING_FORMAT,
                         base64.urlsafe_b64decode(
                             self.session_string + "=" * (-len(self.session_string) % 4)
                         ),
                     )
 
                     await self.dc_id(dc_id)
+
+                    if test_mode:
+                        await self.server_address(TEST[dc_id])
+                        await self.port(80)
+                    else:
+                        await self.server_address(PROD[dc_id])
+                        await self.port(443)
+
+                    await self.api_id(api_id)
                     await self.test_mode(test_mode)
                     await self.auth_key(auth_key)
                     await self.user_id(user_id)
                     await self.is_bot(is_bot)
                     await self.date(0)
 
-                    log.warning(
-                        "You are using an old session string format. Use export_session_string to update"
-                    )
-                    return
-
-                dc_id, api_id, test_mode, auth_key, user_id, is_bot = struct.unpack(
-                    self.SESSION_STRING_FORMAT,
-                    base64.urlsafe_b64decode(
-                        self.session_string + "=" * (-len(self.session_string) % 4)
-                    ),
-                )
-
-                await self.dc_id(dc_id)
-
-                if test_mode:
-                    await self.server_address(TEST[dc_id])
-                    await self.port(80)
-                else:
-                    await self.server_address(PROD[dc_id])
-                    await self.port(443)
-                    
-                await self.api_id(api_id)
-                await self.test_mode(test_mode)
-                await self.auth_key(auth_key)
-                await self.user_id(user_id)
-                await self.is_bot(is_bot)
-                await self.date(0)
-
             return
 
         path = self.database
         file_exists = isinstance(path, Path) and path.is_file()
 
-        self.conn = await aiosqlite.connect(str(path), timeout=1, check_same_thread=False)
+        self.conn = await self.connect(str(path))
 
         if self.use_wal:
             await self.conn.execute("PRAGMA journal_mode=WAL")
         else:
             await self.conn.execute("PRAGMA journal_mode=DELETE")
 
+        await self.apply_pragmas()
+
         if file_exists:
             await self.update()
         else:
             await self.create()
 
-        await self.conn.execute("VACUUM")
-        await self.conn.commit()
+        await self._commit()
+
+        await self.load_session()
+
+        database = f"{Path(path).resolve().as_uri()}?mode=ro"
+
+        for _ in range(self._readers_count):
+            reader = await self.connect(database, uri=True)
+            await self.apply_pragmas(reader)
+
+            self.readers.append(reader)
+
+        if self.state_flush_interval is not None:
+            await self.load_states()
+
+        self.start_write_behind()
+        self.start_state_writer()
+
+        if self.maintenance_interval is not None:
+            self.maintenance_task = asyncio.create_task(self.maintenance_worker())
+
+    @asynccontextmanager
+    async def batch(self):
+        # A nested batch of the same task is part of the outer one
+        if self._batch_task is asyncio.current_task():
+            yield self
+            return
+
+        # Other tasks wait instead of writing into this transaction, so a rollback only undoes this batch
+        async with self._batch_lock:
+            if self.conn.in_transaction:
+                await self._commit()
+
+            self._batch_task = asyncio.current_task()
+
+            try:
+                yield self
+            except BaseException:
+                await self._rollback()
+
+                if self._session is not None:
+                    await self.load_session()
+
+                if self.peer_cache is not None:
+                    self.peer_cache.clear()
+
+                raise
+            else:
+                await self._commit()
+            finally:
+                self._batch_task = None
+
+    @asynccontextmanager
+    async def _write(self):
+        # Reader connections only see committed rows, so with readers every write is committed right away. Without
+        # them writes stay in the open transaction until the next batch(), save() or close(), as plain writes did
+        # before batch() existed.
+        if self.readers:
+            async with self.batch():
+                yield self
+
+            return
+
+        if self._batch_task is asyncio.current_task():
+            yield self
+            return
+
+        # Still serialized with batches, so they never roll back a write of another task
+        async with self._batch_lock:
+            yield self
 
     async def save(self):
-        await self.date(int(time.time()))
-        await self.conn.commit()
+        await self.flush()
+        await self.flush_states()
+
+        async with self.batch():
+            await self.date(int(time.time()))
+
+    async def _delete_peers(self, ids: List[int]) -> Tuple[int, int]:
+        placeholders = ", ".join("?" * len(ids))
+
+        self._write_generation += 1
+
+        async with self.batch():
+            usernames = await self.conn.execute(f"DELETE FROM usernames WHERE id IN ({placeholders})", ids)
+            peers = await self.conn.execute(f"DELETE FROM peers WHERE id IN ({placeholders})", ids)
+
+        if self.peer_cache is not None:
+            for peer_id in ids:
+                self.peer_cache.discard(peer_id)
+
+        return peers.rowcount, usernames.rowcount
+
+    async def prune(self) -> Tuple[int, int]:
+        peers_removed = usernames_removed = 0
+
+        if self.peers_max_age is not None:
+            cutoff = int(time.time() - self.peers_max_age)
+
+            while True:
+                r = await self.conn.execute(
+                    "SELECT id FROM peers WHERE last_update_on < ? ORDER BY last_update_on LIMIT ?",
+                    (cutoff, self.PRUNE_BATCH_SIZE)
+                )
+                ids = [row[0] for row in await r.fetchall()]
+
+                if not ids:
+                    break
+
+                peers, usernames = await self._delete_peers(ids)
+                peers_removed += peers
+                usernames_removed += usernames
+
+                await asyncio.sleep(0)
+
+        if self.peers_max_count is not None:
+            r = await self.conn.execute("SELECT COUNT(*) FROM peers")
+            excess = (await r.fetchone())[0] - self.peers_max_count
+
+            while excess > 0:
+                r = await self.conn.execute(
+                    "SELECT id FROM peers ORDER BY last_update_on LIMIT ?",
+                    (min(excess, self.PRUNE_BATCH_SIZE),)
+                )
+                ids = [row[0] for row in await r.fetchall()]
+
+                if not ids:
+                    break
+
+                peers, usernames = await self._delete_peers(ids)
+                peers_removed += peers
+                usernames_removed += usernames
+                excess -= len(ids)
+
+                await asyncio.sleep(0)
+
+        if peers_removed:
+            log.info("Pruned %s peers and %s usernames from %s", peers_removed, usernames_removed, self.database)
+
+        return peers_removed, usernames_removed
+
+    async def maintenance(self):
+        # Inside a batch of this task it would commit the batch halfway, other tasks' writes are waited for below
+        if self._batch_task is asyncio.current_task():
+            return
+
+        if self.peers_max_count is not None or self.peers_max_age is not None:
+            await self.prune()
+
+        # VACUUM can't run inside a transaction, so batches wait until it is done
+        async with self._batch_lock:
+            if self.conn.in_transaction:
+                await self._commit()
+
+            auto_vacuum = (await (await self.conn.execute("PRAGMA auto_vacuum")).fetchone())[0]
+            page_count = (await (await self.conn.execute("PRAGMA page_count")).fetchone())[0]
+            freelist_count = (await (await self.conn.execute("PRAGMA freelist_count")).fetchone())[0]
+
+            if self.auto_vacuum and auto_vacuum != 2:
+                log.info("Converting %s to incremental auto vacuum", self.database)
+
+                await self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                await self.conn.execute("VACUUM")
+            elif auto_vacuum == 2 and freelist_count:
+                # sqlite3 steps a statement only once per execute(), which frees a single page
+                await self.conn.executescript(f"PRAGMA incremental_vacuum({self.INCREMENTAL_VACUUM_PAGES});")
+            elif self.vacuum_threshold is not None and page_count and freelist_count / page_count >= self.vacuum_threshold:
+                log.info("Vacuuming %s (%s of %s pages free)", self.database, freelist_count, page_count)
+
+                await self.conn.execute("VACUUM")
+
+            await self.conn.execute("PRAGMA optimize")
+
+    async def maintenance_worker(self):
+        while True:
+            # The first pass waits as well, a VACUUM right after open() would hold up every query
+            await asyncio.sleep(self.maintenance_interval)
+
+            try:
+                await self.maintenance()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Storage maintenance failed: %s", e)
+
+    async def restore(self):
+        source = await self.connect(str(self.snapshot_path))
+
+        try:
+            await source.backup(self.conn)
+        finally:
+            await source.close()
+
+    async def snapshot(self):
+        if self._batch_task is asyncio.current_task():
+            return
+
+        await self.flush()
+        await self.flush_states()
+
+        temp_path = self.snapshot_path.with_name(self.snapshot_path.name + ".tmp")
+        target = sqlite3.connect(str(temp_path), check_same_thread=False)
+
+        try:
+            # A batch running in another task must not be committed halfway by the snapshot
+            async with self._batch_lock:
+                for attempt in range(self.SNAPSHOT_ATTEMPTS):
+                    await self._commit()
+
+                    try:
+                        # Copied in steps of SNAPSHOT_PAGES on the connection thread, the event loop keeps running
+                        await self.conn.backup(target, pages=self.SNAPSHOT_PAGES, progress=abort_if_busy, sleep=0)
+                    except SnapshotBusy:
+                        await asyncio.sleep(0)
+                    else:
+                        break
+                else:
+                    raise SnapshotBusy(f"Database stayed busy for {self.SNAPSHOT_ATTEMPTS} attempts")
+        finally:
+            target.close()
+
+        os.replace(temp_path, self.snapshot_path)
+
+    async def snapshot_worker(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+
+            try:
+                await self.snapshot()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Snapshot of %s failed: %s", self.name, e)
+
+    @staticmethod
+    async def _stop_task(task: Optional[asyncio.Task]):
+        if task is None:
+            return
+
+        task.cancel()
+
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
 
     async def close(self):
+        for task in (self.snapshot_task, self.maintenance_task, self.write_behind_task, self.state_task):
+            await self._stop_task(task)
+
+        self.snapshot_task = self.maintenance_task = self.write_behind_task = self.state_task = None
+
+        await self.flush()
+        await self.flush_states()
+
+        async with self._batch_lock:
+            await self._commit()
+
+        if self.snapshot_path is not None:
+            await self.snapshot()
+
+        for reader in self.readers:
+            await reader.close()
+
+        self.readers.clear()
+
         await self.conn.close()
 
+        if self.tracer is not None:
+            self.tracer.close()
+
+        self._session = None
+        self._states = None
+
+        if self.peer_cache is not None:
+            self.peer_cache.clear()
+
     async def delete(self):
         if not self.in_memory:
             Path(self.database).unlink()
 
-    async def update_peers(self, peers: List[Tuple[int, int, str, str]]):
+    def start_write_behind(self):
+        if self.write_behind and self.write_behind_interval is not None:
+            self.write_behind_task = asyncio.create_task(self.write_behind_worker())
+
+    async def write_behind_worker(self):
+        while True:
+            await asyncio.sleep(self.write_behind_interval)
+
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Flushing pending peers failed: %s", e)
+
+    async def flush(self):
+        if not self._pending_peers and not self._pending_usernames:
+            return
+
+        peers = self._pending_peers
+        usernames = self._pending_usernames
+
+        self._pending_peers = {}
+        self._pending_phone_numbers = {}
+        self._pending_usernames = {}
+        self._pending_username_ids = {}
+
+        try:
+            async with self.batch():
+                await self._write_peers(list(peers.values()))
+                await self._write_usernames(list(usernames.items()))
+        except BaseException:
+            # Keep them for the next flush unless newer ones arrived meanwhile
+            self._buffer_peers([peer for peer_id, peer in peers.items() if peer_id not in self._pending_peers])
+            self._buffer_usernames([
+                (peer_id, names) for peer_id, names in usernames.items() if peer_id not in self._pending_usernames
+            ])
+
+            raise
+
+    async def _write_peers(self, peers: List[Tuple[int, int, str, str]]):
+        self._write_generation += 1
+
         await self.conn.executemany(
-            "REPLACE INTO peers (id, access_hash, type, phone_number) VALUES (?, ?, ?, ?)", peers
+            "INSERT INTO peers (id, access_hash, type, phone_number, last_update_on) "
+            "VALUES (?, ?, ?, ?, CAST(STRFTIME('%s', 'now') AS INTEGER)) "
+            "ON CONFLICT (id) DO UPDATE SET "
+            "access_hash = excluded.access_hash, "
+            "type = excluded.type, "
+            "phone_number = excluded.phone_number, "
+            "last_update_on = excluded.last_update_on",
+            [
+                (peer_id, access_hash, PEER_TYPES.get(peer_type, peer_type), phone_number)
+                for peer_id, access_hash, peer_type, phone_number in peers
+            ]
         )
 
+    async def _write_usernames(self, usernames: List[Tuple[int, List[str]]]):
+        ids = list({id for id, _ in usernames})
+        stored = set()
+
+        for i in range(0, len(ids), self.QUERY_CHUNK_SIZE):
+            chunk = ids[i:i + self.QUERY_CHUNK_SIZE]
+
+            r = await self.conn.execute(
+                f"SELECT id, username FROM usernames WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+            )
+
+            stored.update(await r.fetchall())
+
+        # Later entries for the same id win, like consecutive DELETE + INSERT did
+        wanted = dict(usernames)
+        target = {(id, username) for id, names in wanted.items() for username in names}
+
+        removed = stored - target
+        added = target - stored
+
+        if removed or added:
+            self._write_generation += 1
+
+        if removed:
+            await self.conn.executemany("DELETE FROM usernames WHERE id = ? AND username = ?", removed)
+
+        if added:
+            await self.conn.executemany("INSERT INTO usernames (id, username) VALUES (?, ?)", added)
+
+    def _buffer_peers(self, peers: List[Tuple[int, int, str, str]]):
+        for peer in peers:
+            peer_id, phone_number = peer[0], peer[3]
+            pending = self._pending_peers.get(peer_id)
+
+            if pending is not None and self._pending_phone_numbers.get(pending[3]) == peer_id:
+                del self._pending_phone_numbers[pending[3]]
+
+            self._pending_peers[peer_id] = peer
+
+            if phone_number:
+                self._pending_phone_numbers[phone_number] = peer_id
+
+    def _buffer_usernames(self, usernames: List[Tuple[int, List[str]]]):
+        for peer_id, names in usernames:
+            for username in self._pending_usernames.get(peer_id, ()):
+                if self._pending_username_ids.get(username) == peer_id:
+                    del self._pending_username_ids[username]
+
+            self._pending_usernames[peer_id] = names
+
+            for username in names:
+                self._pending_username_ids[username] = peer_id
+
+    def _pending_size(self):
+        return len(self._pending_peers) + len(self._pending_usernames)
+
+    async def update_peers(self, peers: List[Tuple[int, int, str, str]]):
+        if self.write_behind:
+            self._buffer_peers(peers)
+        else:
+            async with self._write():
+                await self._write_peers(peers)
+
+        if self.peer_cache is not None:
+            now = int(time.time())
+
+            for peer_id, access_hash, peer_type, phone_number in peers:
+                self.peer_cache.put(peer_id, access_hash, peer_type, phone_number, now)
+
+        if self.write_behind and self._pending_size() >= self.write_behind_size:
+            await self.flush()
+
     async def update_usernames(self, usernames: List[Tuple[int, List[str]]]):
-        await self.conn.executemany("DELETE FROM usernames WHERE id = ?", [(id,) for id, _ in usernames])
+        if self.write_behind:
+            self._buffer_usernames(usernames)
+        else:
+            async with self._write():
+                await self._write_usernames(usernames)
 
-        await self.conn.executemany(
-            "REPLACE INTO usernames (id, username) VALUES (?, ?)",
-            [(id, username) for id, usernames in usernames for username in usernames],
-        )
+        if self.peer_cache is not None:
+            for id, names in usernames:
+                self.peer_cache.put_usernames(id, names)
+
+        if self.write_behind and self._pending_size() >= self.write_behind_size:
+            await self.flush()
+
+    async def state_worker(self):
+        while True:
+            await asyncio.sleep(self.state_flush_interval)
+
+            try:
+                await self.flush_states()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Flushing update states failed: %s", e)
+
+    async def flush_states(self):
+        if not self._pending_states:
+            return
+
+        states = self._pending_states
+        self._pending_states = {}
+
+        try:
+            async with self.batch():
+                deleted = [(id,) for id, state in states.items() if state is None]
+                updated = [state for state in states.values() if state is not None]
+
+                if deleted:
+                    await self.conn.executemany("DELETE FROM update_state WHERE id = ?", deleted)
+
+                if updated:
+                    await self.conn.executemany(
+                        "REPLACE INTO update_state (id, pts, qts, date, seq) VALUES (?, ?, ?, ?, ?)",
+                        updated,
+                    )
+        except BaseException:
+            # Keep the states for the next flush unless newer ones arrived meanwhile
+            for id, state in states.items():
+                self._pending_states.setdefault(id, state)
+
+            raise
 
     async def update_state(self, value: Tuple[int, int, int, int, int] = object):
+        if self._states is not None:
+            if value is object:
+                return sorted(self._states.values(), key=lambda state: state[3])
+
+            if isinstance(value, int):
+                self._states.pop(value, None)
+                self._pending_states[value] = None
+            else:
+                self._states[value[0]] = tuple(value)
+                self._pending_states[value[0]] = tuple(value)
+
+            return
+
         if value is object:
             r = await self.conn.execute(
                 "SELECT id, pts, qts, date, seq FROM update_state ORDER BY date ASC"
@@ -323,61 +1288,261 @@ class AIOSQLiteStorage(Storage):
 
             return await r.fetchall()
         else:
-            if isinstance(value, int):
-                await self.conn.execute("DELETE FROM update_state WHERE id = ?", (value,))
-            else:
-                await self.conn.execute(
-                    "REPLACE INTO update_state (id, pts, qts, date, seq) VALUES (?, ?, ?, ?, ?)",
-                    value,
-                )
+            async with self._write():
+                if isinstance(value, int):
+                    await self.conn.execute("DELETE FROM update_state WHERE id = ?", (value,))
+                else:
+                    await self.conn.execute(
+                        "REPLACE INTO update_state (id, pts, qts, date, seq) VALUES (?, ?, ?, ?, ?)",
+                        value,
+                    )
 
     async def get_peer_by_id(self, peer_id: int):
-        r = await (await self.conn.execute(
-            "SELECT id, access_hash, type FROM peers WHERE id = ?",
+        if self.peer_cache is not None:
+            r = self.peer_cache.get_by_id(peer_id)
+
+            if r is not None:
+                return get_input_peer(*r[:3])
+
+        r = self._pending_peers.get(peer_id)
+
+        if r is not None:
+            return get_input_peer(*r[:3])
+
+        r = await (await self._reader().execute(
+            "SELECT id, access_hash, type, phone_number, last_update_on FROM peers WHERE id = ?",
             (peer_id,)
         )).fetchone()
 
         if r is None:
             raise KeyError(f"ID not found: {peer_id}")
 
-        return get_input_peer(*r)
+        r = decode_peer(*r)
+
+        if self.peer_cache is not None:
+            self.peer_cache.put(*r)
+
+        return get_input_peer(*r[:3])
 
     async def get_peer_by_username(self, username: str):
-        r = await (await self.conn.execute(
-            "SELECT p.id, p.access_hash, p.type, p.last_update_on FROM peers p "
-            "JOIN usernames u ON p.id = u.id "
-            "WHERE u.username = ? "
-            "ORDER BY p.last_update_on DESC",
-            (username,)
-        )).fetchone()
+        r = None
 
-        if r is None:
-            raise KeyError(f"Username not found: {username}")
+        if self.peer_cache is not None:
+            r = self.peer_cache.get_by_username(username)
+
+        if r is None and username in self._pending_username_ids:
+            peer_id = self._pending_username_ids[username]
+            pending = self._pending_peers.get(peer_id)
+
+            if pending is not None:
+                return get_input_peer(*pending[:3])
+
+            r = await (await self._reader().execute(
+                "SELECT id, access_hash, type, phone_number, last_update_on FROM peers WHERE id = ?",
+                (peer_id,)
+            )).fetchone()
+
+            if r is None:
+                raise KeyError(f"Username not found: {username}")
+
+            r = decode_peer(*r)
+        elif r is None:
+            rows = await (await self._reader().execute(
+                "SELECT p.id, p.access_hash, p.type, p.phone_number, p.last_update_on FROM peers p "
+                "JOIN usernames u ON p.id = u.id "
+                "WHERE u.username = ? "
+                "ORDER BY p.last_update_on DESC",
+                (username,)
+            )).fetchall()
+
+            # Stored usernames of peers with buffered ones are about to be replaced
+            rows = [row for row in rows if row[0] not in self._pending_usernames]
+
+            if not rows:
+                raise KeyError(f"Username not found: {username}")
+
+            r = decode_peer(*rows[0])
+            pending = self._pending_peers.get(r[0])
+
+            if pending is not None:
+                return get_input_peer(*pending[:3])
 
-        if abs(time.time() - r[3]) > self.USERNAME_TTL:
+            if self.peer_cache is not None:
+                self.peer_cache.put(*r)
+                self.peer_cache.add_username(r[0], username)
+
+        if abs(time.time() - r[4]) > self.USERNAME_TTL:
             raise KeyError(f"Username expired: {username}")
 
         return get_input_peer(*r[:3])
 
     async def get_peer_by_phone_number(self, phone_number: str):
-        r = await (await self.conn.execute(
-            "SELECT id, access_hash, type FROM peers WHERE phone_number = ?",
+        if self.peer_cache is not None:
+            r = self.peer_cache.get_by_phone_number(phone_number)
+
+            if r is not None:
+                return get_input_peer(*r[:3])
+
+        r = self._pending_peers.get(self._pending_phone_numbers.get(phone_number))
+
+        if r is not None:
+            return get_input_peer(*r[:3])
+
+        r = await (await self._reader().execute(
+            "SELECT id, access_hash, type, phone_number, last_update_on FROM peers WHERE phone_number = ?",
             (phone_number,)
         )).fetchone()
 
         if r is None:
             raise KeyError(f"Phone number not found: {phone_number}")
 
-        return get_input_peer(*r)
+        r = decode_peer(*r)
+
+        if r[0] in self._pending_peers:
+            # The buffered peer has a different phone number, the stored one is outdated
+            await self.flush()
+
+            return await self.get_peer_by_phone_number(phone_number)
+
+        if self.peer_cache is not None:
+            self.peer_cache.put(*r)
+
+        return get_input_peer(*r[:3])
+
+    async def get_peers_by_ids(self, ids: List[int]) -> Tuple[Dict[int, Any], List[int]]:
+        ids = list(dict.fromkeys(ids))
+        peers = {}
+        remaining = []
+
+        for peer_id in ids:
+            r = None
+
+            if self.peer_cache is not None:
+                r = self.peer_cache.get_by_id(peer_id)
+
+            if r is None:
+                r = self._pending_peers.get(peer_id)
+
+            if r is None:
+                remaining.append(peer_id)
+            else:
+                peers[peer_id] = get_input_peer(*r[:3])
+
+        conn = self._reader()
+
+        for i in range(0, len(remaining), self.QUERY_CHUNK_SIZE):
+            chunk = remaining[i:i + self.QUERY_CHUNK_SIZE]
+
+            rows = await (await conn.execute(
+                "SELECT id, access_hash, type, phone_number, last_update_on FROM peers "
+                f"WHERE id IN ({', '.join('?' * len(chunk))})",
+                chunk
+            )).fetchall()
+
+            for r in rows:
+                r = decode_peer(*r)
+
+                if self.peer_cache is not None:
+                    self.peer_cache.put(*r)
+
+                peers[r[0]] = get_input_peer(*r[:3])
+
+        return peers, [peer_id for peer_id in ids if peer_id not in peers]
+
+    async def get_peers_by_usernames(self, usernames: List[str]) -> Tuple[Dict[str, Any], List[str]]:
+        usernames = list(dict.fromkeys(usernames))
+        now = time.time()
+        peers = {}
+        remaining = []
+        # Buffered usernames of peers that are only stored, username -> peer id
+        stored_ids = {}
+
+        for username in usernames:
+            r = None
+
+            if self.peer_cache is not None:
+                r = self.peer_cache.get_by_username(username)
+
+            if r is None and username in self._pending_username_ids:
+                peer_id = self._pending_username_ids[username]
+                pending = self._pending_peers.get(peer_id)
+
+                if pending is not None:
+                    peers[username] = get_input_peer(*pending[:3])
+                else:
+                    stored_ids[username] = peer_id
+            elif r is None:
+                remaining.append(username)
+            elif abs(now - r[4]) <= self.USERNAME_TTL:
+                peers[username] = get_input_peer(*r[:3])
+
+        conn = self._reader()
+        ids = list(set(stored_ids.values()))
+        stored = {}
+
+        for i in range(0, len(ids), self.QUERY_CHUNK_SIZE):
+            chunk = ids[i:i + self.QUERY_CHUNK_SIZE]
+
+            rows = await (await conn.execute(
+                "SELECT id, access_hash, type, phone_number, last_update_on FROM peers "
+                f"WHERE id IN ({', '.join('?' * len(chunk))})",
+                chunk
+            )).fetchall()
+
+            for r in rows:
+                stored[r[0]] = decode_peer(*r)
+
+        for username, peer_id in stored_ids.items():
+            r = stored.get(peer_id)
+
+            if r is not None and abs(now - r[4]) <= self.USERNAME_TTL:
+                peers[username] = get_input_peer(*r[:3])
+
+        for i in range(0, len(remaining), self.QUERY_CHUNK_SIZE):
+            chunk = remaining[i:i + self.QUERY_CHUNK_SIZE]
+
+            rows = await (await conn.execute(
+                "SELECT u.username, p.id, p.access_hash, p.type, p.phone_number, p.last_update_on FROM peers p "
+                "JOIN usernames u ON p.id = u.id "
+                f"WHERE u.username IN ({', '.join('?' * len(chunk))}) "
+                "ORDER BY p.last_update_on ASC",
+                chunk
+            )).fetchall()
+
+            # Rows are ordered by date, so the most recently updated peer wins. Stored usernames of peers with
+            # buffered ones are about to be replaced.
+            latest = {r[0]: decode_peer(*r[1:]) for r in rows if r[1] not in self._pending_usernames}
+
+            for username, r in latest.items():
+                pending = self._pending_peers.get(r[0])
+
+                if pending is not None:
+                    peers[username] = get_input_peer(*pending[:3])
+                    continue
+
+                if self.peer_cache is not None:
+                    self.peer_cache.put(*r)
+                    self.peer_cache.add_username(r[0], username)
+
+                if abs(now - r[4]) <= self.USERNAME_TTL:
+                    peers[username] = get_input_peer(*r[:3])
+
+        return peers, [username for username in usernames if username not in peers]
 
     async def _get(self, table: str, attr: str):
+        if table == "sessions" and self._session is not None:
+            return self._session[attr]
+
         r = await self.conn.execute(f"SELECT {attr} FROM {table}")
 
         return (await r.fetchone())[0]
 
     async def _set(self, table: str, attr: str, value: Any):
-        await self.conn.execute(f"UPDATE {table} SET {attr} = ?", (value,))
-        await self.conn.commit()
+        async with self.batch():
+            await self.conn.execute(f"UPDATE {table} SET {attr} = ?", (value,))
+
+        if table == "sessions" and self._session is not None:
+            self._session[attr] = value
 
     async def _accessor(self, table: str, attr: str, value: Any = object):
         return await self._get(table, attr) if value is object else await self._set(table, attr, value)
@@ -0,0 +1,431 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import asyncpg
+from pyrogram import Client, raw, utils
+from pyrogram.storage import Storage
+
+from pg_migrations import MIGRATION_LOCK, MIGRATIONS, SCHEMA_MIGRATIONS
+
+log = logging.getLogger(__name__)
+
+# asyncpg keeps a server-side prepared statement per connection for each of these
+GET_SESSION = "SELECT dc_id, api_id, test_mode, auth_key, date, user_id, is_bot FROM sessions WHERE session_name = $1"
+
+CREATE_SESSION = "INSERT INTO sessions (session_name, dc_id, date) VALUES ($1, 2, $2) ON CONFLICT DO NOTHING"
+
+GET_PEER_BY_ID = "SELECT id, access_hash, type FROM peers WHERE session_name = $1 AND id = $2"
+
+GET_PEER_BY_USERNAME = """
+SELECT p.id, p.access_hash, p.type, p.last_update_on
+FROM usernames u
+JOIN peers p ON p.session_name = u.session_name AND p.id = u.id
+WHERE u.session_name = $1 AND u.username = $2
+ORDER BY p.last_update_on DESC NULLS LAST
+LIMIT 1
+"""
+
+GET_PEER_BY_PHONE_NUMBER = """
+SELECT id, access_hash, type FROM peers WHERE session_name = $1 AND phone_number = $2 LIMIT 1
+"""
+
+GET_PEERS_BY_IDS = "SELECT id, access_hash, type FROM peers WHERE session_name = $1 AND id = ANY($2::BIGINT[])"
+
+GET_PEERS_BY_USERNAMES = """
+SELECT u.username, p.id, p.access_hash, p.type, p.last_update_on
+FROM usernames u
+JOIN peers p ON p.session_name = u.session_name AND p.id = u.id
+WHERE u.session_name = $1 AND u.username = ANY($2::VARCHAR[])
+ORDER BY p.last_update_on ASC NULLS FIRST
+"""
+
+UPSERT_PEERS = """
+INSERT INTO peers (session_name, id, access_hash, type, phone_number, last_update_on)
+SELECT $1, unnest($2::BIGINT[]), unnest($3::BIGINT[]), unnest($4::VARCHAR[]), unnest($5::VARCHAR[]),
+       extract(epoch FROM now())::BIGINT
+ON CONFLICT (session_name, id) DO UPDATE SET
+    access_hash = excluded.access_hash,
+    type = excluded.type,
+    phone_number = excluded.phone_number,
+    last_update_on = excluded.last_update_on
+"""
+
+UPDATE_USERNAMES = """
+WITH new AS (
+    SELECT unnest($3::BIGINT[]) AS id, unnest($4::VARCHAR[]) AS username
+), deleted AS (
+    DELETE FROM usernames u
+    WHERE u.session_name = $1 AND u.id = ANY($2::BIGINT[])
+    AND NOT EXISTS (SELECT 1 FROM new WHERE new.id = u.id AND new.username = u.username)
+)
+INSERT INTO usernames (session_name, id, username)
+SELECT $1, id, username FROM new
+ON CONFLICT DO NOTHING
+"""
+
+GET_STATES = "SELECT id, pts, qts, date, seq FROM update_state WHERE session_name = $1 ORDER BY date ASC"
+
+DELETE_STATE = "DELETE FROM update_state WHERE session_name = $1 AND id = $2"
+
+SET_STATE = """
+INSERT INTO update_state (session_name, id, pts, qts, date, seq)
+VALUES ($1, $2, $3, $4, $5, $6)
+ON CONFLICT (session_name, id) DO UPDATE SET
+    pts = excluded.pts,
+    qts = excluded.qts,
+    date = excluded.date,
+    seq = excluded.seq
+"""
+
+
+async def migrate(conn: asyncpg.Connection) -> int:
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK)
+        await conn.execute(SCHEMA_MIGRATIONS)
+
+        version = await conn.fetchval("SELECT coalesce(max(version), 0) FROM schema_migrations")
+
+        for statements in MIGRATIONS[version:]:
+            for statement in statements:
+                await conn.execute(statement)
+
+            version += 1
+
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, applied_on) VALUES ($1, extract(epoch FROM now()))", version
+            )
+
+            log.info("Migrated the multi-session schema to version %d", version)
+
+    return version
+
+
+def get_input_peer(peer_id: int, access_hash: int, peer_type: str):
+    if peer_type in ["user", "bot"]:
+        return raw.types.InputPeerUser(
+            user_id=peer_id,
+            access_hash=access_hash
+        )
+
+    if peer_type == "group":
+        return raw.types.InputPeerChat(
+            chat_id=-peer_id
+        )
+
+    if peer_type in ["direct", "channel", "forum", "supergroup"]:
+        return raw.types.InputPeerChannel(
+            channel_id=utils.get_channel_id(peer_id),
+            access_hash=access_hash
+        )
+
+    raise ValueError(f"Invalid peer type: {peer_type}")
+
+
+class PoolRegistry:
+    def __init__(self, min_size: int = 1, max_size: int = 10, **kwargs):
+        self.options = dict(min_size=min_size, max_size=max_size, **kwargs)
+        self.pools = {}  # type: Dict[str, asyncio.Future]
+        self.references = {}  # type: Dict[str, int]
+        self.migrated = set()
+
+    async def acquire(self, dsn: str) -> asyncpg.Pool:
+        # Storages opened at the same time wait for the same pool instead of creating their own
+        if dsn not in self.pools:
+            self.pools[dsn] = asyncio.ensure_future(asyncpg.create_pool(dsn, **self.options))
+            self.references[dsn] = 0
+
+        self.references[dsn] += 1
+
+        try:
+            return await self.pools[dsn]
+        except BaseException:
+            await self.release(dsn)
+            raise
+
+    async def release(self, dsn: str):
+        self.references[dsn] -= 1
+
+        if not self.references[dsn]:
+            del self.references[dsn]
+            pool = self.pools.pop(dsn)
+
+            if pool.done() and not pool.cancelled() and pool.exception() is None:
+                await pool.result().close()
+
+    async def migrate(self, dsn: str):
+        # Each database is migrated once per process, not on every open()
+        if dsn in self.migrated:
+            return
+
+        async with (await self.pools[dsn]).acquire() as conn:
+            await migrate(conn)
+
+        self.migrated.add(dsn)
+
+    async def close(self):
+        pools = list(self.pools.values())
+
+        self.pools.clear()
+        self.references.clear()
+        self.migrated.clear()
+
+        for pool in pools:
+            if pool.done() and not pool.cancelled() and pool.exception() is None:
+                await pool.result().close()
+
+
+pools = PoolRegistry()
+
+
+class MultiAsyncpgStorage(Storage):
+    VERSION = len(MIGRATIONS)
+    USERNAME_TTL = 8 * 60 * 60
+
+    def __init__(
+        self,
+        client: Client,
+        database: Union[dict, str],
+        registry: Optional[PoolRegistry] = None,
+        migrate: bool = True,
+    ):
+        super().__init__(client.name)
+
+        if isinstance(database, str):
+            # URLs written for the SQLAlchemy storage work as well
+            self.dsn = database.replace("postgresql+asyncpg://", "postgresql://", 1)
+        else:
+            self.dsn = f"postgresql://{database['db_user']}:{database['db_pass']}@{database['db_host']}:{database['db_port']}/{database['db_name']}"
+
+        self.registry = registry or pools
+        self.pool = None  # type: Optional[asyncpg.Pool]
+        self.migrate = migrate
+
+        self._session = None  # type: Optional[Dict[str, Any]]
+        self._pending_session = {}  # type: Dict[str, Any]
+        self._batch_lock = asyncio.Lock()
+        self._batch_task = None  # type: Optional[asyncio.Task]
+
+    async def create(self):
+        await self.pool.execute(CREATE_SESSION, self.name, int(time.time()))
+
+    async def open(self):
+        if self.pool is None:
+            self.pool = await self.registry.acquire(self.dsn)
+
+        if self.migrate:
+            await self.registry.migrate(self.dsn)
+
+        await self.load_session()
+
+        if self._session is None:
+            await self.create()
+            await self.load_session()
+
+    async def load_session(self):
+        row = await self.pool.fetchrow(GET_SESSION, self.name)
+        self._session = dict(row) if row is not None else None
+
+    async def save(self):
+        await self.date(int(time.time()))
+
+    async def close(self):
+        self._session = None
+
+        if self.pool is not None:
+            self.pool = None
+            await self.registry.release(self.dsn)
+
+    async def delete(self):
+        # Pyrogram deletes the session after closing the storage
+        released = self.pool is None
+
+        if released:
+            self.pool = await self.registry.acquire(self.dsn)
+
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute("DELETE FROM update_state WHERE session_name = $1", self.name)
+                    await conn.execute("DELETE FROM usernames WHERE session_name = $1", self.name)
+                    await conn.execute("DELETE FROM peers WHERE session_name = $1", self.name)
+                    await conn.execute("DELETE FROM sessions WHERE session_name = $1", self.name)
+        finally:
+            if released:
+                await self.close()
+
+    async def update_peers(self, peers: List[Tuple[int, int, str, str]]):
+        # ON CONFLICT can't touch the same row twice in one statement, the last value per id wins
+        peers = list({peer[0]: peer for peer in peers}.values())
+
+        if not peers:
+            return
+
+        ids, access_hashes, types, phone_numbers = zip(*peers)
+
+        await self.pool.execute(UPSERT_PEERS, self.name, ids, access_hashes, types, phone_numbers)
+
+    async def update_usernames(self, usernames: List[Tuple[int, List[str]]]):
+        usernames = {telegram_id: user_list for telegram_id, user_list in usernames}
+
+        if not usernames:
+            return
+
+        rows = [(telegram_id, username) for telegram_id, user_list in usernames.items() for username in user_list]
+        ids, names = zip(*rows) if rows else ((), ())
+
+        await self.pool.execute(UPDATE_USERNAMES, self.name, list(usernames), ids, names)
+
+    async def update_state(self, value: Tuple[int, int, int, int, int] = object):
+        if value is object:
+            return [tuple(row) for row in await self.pool.fetch(GET_STATES, self.name)]
+
+        if isinstance(value, int):
+            await self.pool.execute(DELETE_STATE, self.name, value)
+        else:
+            await self.pool.execute(SET_STATE, self.name, *value)
+
+    async def get_peer_by_id(self, peer_id: int):
+        r = await self.pool.fetchrow(GET_PEER_BY_ID, self.name, peer_id)
+
+        if r is None:
+            raise KeyError(f"ID not found: {peer_id}")
+
+        return get_input_peer(*r)
+
+    async def get_peer_by_username(self, username: str):
+        r = await self.pool.fetchrow(GET_PEER_BY_USERNAME, self.name, username)
+
+        if r is None:
+            raise KeyError(f"Username not found: {username}")
+
+        if r[3] and abs(time.time() - r[3]) > self.USERNAME_TTL:
+            raise KeyError(f"Username expired: {username}")
+
+        return get_input_peer(*r[:3])
+
+    async def get_peer_by_phone_number(self, phone_number: str):
+        r = await self.pool.fetchrow(GET_PEER_BY_PHONE_NUMBER, self.name, phone_number)
+
+        if r is None:
+            raise KeyError(f"Phone number not found: {phone_number}")
+
+        return get_input_peer(*r)
+
+    async def get_peers_by_ids(self, ids: List[int]) -> Tuple[Dict[int, Any], List[int]]:
+        ids = list(dict.fromkeys(ids))
+
+        peers = {r[0]: get_input_peer(*r) for r in await self.pool.fetch(GET_PEERS_BY_IDS, self.name, ids)}
+
+        return peers, [peer_id for peer_id in ids if peer_id not in peers]
+
+    async def get_peers_by_usernames(self, usernames: List[str]) -> Tuple[Dict[str, Any], List[str]]:
+        usernames = list(dict.fromkeys(usernames))
+        now = time.time()
+
+        # Rows are ordered by date, so the most recently updated peer wins
+        peers = {
+            r[0]: get_input_peer(*r[1:4])
+            for r in await self.pool.fetch(GET_PEERS_BY_USERNAMES, self.name, usernames)
+            if not r[4] or abs(now - r[4]) <= self.USERNAME_TTL
+        }
+
+        return peers, [username for username in usernames if username not in peers]
+
+    @asynccontextmanager
+    async def batch(self):
+        # A nested batch of the same task is part of the outer one
+        if self._batch_task is asyncio.current_task():
+            yield self
+            return
+
+        # Accessor writes of other tasks wait instead of joining this batch, so a failed batch only drops its own writes
+        async with self._batch_lock:
+            self._batch_task = asyncio.current_task()
+
+            try:
+                yield self
+            except BaseException:
+                self._pending_session.clear()
+
+                if self._session is not None:
+                    await self.load_session()
+
+                raise
+            else:
+                await self.flush_session()
+            finally:
+                self._batch_task = None
+
+    async def flush_session(self):
+        if not self._pending_session:
+            return
+
+        values = self._pending_session
+        self._pending_session = {}
+
+        await self._update_session(values)
+
+    async def _update_session(self, values: Dict[str, Any]):
+        columns = ", ".join(f"{column} = ${i}" for i, column in enumerate(values, start=2))
+
+        status = await self.pool.execute(
+            f"UPDATE sessions SET {columns} WHERE session_name = $1", self.name, *values.values()
+        )
+
+        if status == "UPDATE 0":
+            raise ValueError(f"Session with name {self.name} not found.")
+
+    async def _get(self, attr: str):
+        if self._session is not None:
+            return self._session[attr]
+
+        return await self.pool.fetchval(f"SELECT {attr} FROM sessions WHERE session_name = $1", self.name)
+
+    async def _set(self, attr: str, value: Any):
+        if self._batch_task is asyncio.current_task():
+            self._pending_session[attr] = value
+        else:
+            async with self._batch_lock:
+                await self._update_session({attr: value})
+
+        if self._session is not None:
+            self._session[attr] = value
+
+    async def _accessor(self, attr: str, value: Any = object):
+        if value is object:
+            return await self._get(attr)
+        else:
+            await self._set(attr, value)
+
+    async def dc_id(self, value: int = object):
+        return await self._accessor("dc_id", value)
+
+    async def api_id(self, value: int = object):
+        return await self._accessor("api_id", value)
+
+    async def test_mode(self, value: bool = object):
+        return await self._accessor("test_mode", value)
+
+    async def auth_key(self, value: bytes = object):
+        return await self._accessor("auth_key", value)
+
+    async def date(self, value: int = object):
+        return await self._accessor("date", value)
+
+    async def user_id(self, value: int = object):
+        return await self._accessor("user_id", value)
+
+    async def is_bot(self, value: bool = object):
+        return await self._accessor("is_bot", value)
+
+    async def version(self, value: int = object):
+        if value is object:
+            return await self.pool.fetchval("SELECT max(version) FROM schema_migrations")
+
+        await self.pool.execute(
+            "INSERT INTO schema_migrations (version, applied_on) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+            value, int(time.time())
+        )
@@ -0,0 +1,159 @@
+import argparse
+import ast
+import asyncio
+import json
+import logging
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from . import workloads
+from .backends import BACKENDS
+
+log = logging.getLogger("benchmark")
+
+
+def parse_options(values: List[str]) -> Dict[str, Dict[str, Any]]:
+    options = {}  # type: Dict[str, Dict[str, Any]]
+
+    for value in values:
+        key, _, raw = value.partition("=")
+        backend, _, name = key.partition(".")
+
+        if backend not in BACKENDS or not name:
+            raise ValueError(f"Invalid option: {value}")
+
+        try:
+            parsed = ast.literal_eval(raw)
+        except (ValueError, SyntaxError):
+            parsed = raw
+
+        options.setdefault(backend, {})[name] = parsed
+
+    return options
+
+
+async def run_backend(backend: str, peers: int, args, options: Dict[str, Any]) -> Dict[str, Any]:
+    dataset = workloads.Dataset(peers, args.seed)
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="pyrogram_storages_") as workdir:
+        name = f"bench_{backend}_{peers}_{int(time.time())}"
+        storage = await BACKENDS[backend](name, Path(workdir), options)
+
+        steps = [
+            ("create", lambda: workloads.create(storage)),
+            ("update_peers", lambda: workloads.update_peers(storage, dataset, args.batch_size)),
+            ("open_close", lambda: workloads.open_close(storage, args.repeat)),
+            ("lookups", lambda: workloads.lookups(
+                storage, dataset, args.lookups, workloads.parse_mix(args.mix), args.miss_ratio, args.seed
+            )),
+            ("update_state", lambda: workloads.update_state(storage, args.states, args.channels, args.seed)),
+            ("accessors", lambda: workloads.accessors(storage, args.accessors)),
+        ]
+
+        try:
+            for workload, step in steps:
+                log.info("%s: %s (%d peers)", backend, workload, peers)
+
+                try:
+                    results.append(await step())
+                except Exception as e:
+                    # A broken workload is reported instead of aborting the whole run
+                    log.exception("%s: %s failed", backend, workload)
+                    results.append({"workload": workload, "error": f"{type(e).__name__}: {e}"})
+
+            # Postgres data outlives the temporary directory
+            if backend in ("postgres_multisession", "asyncpg_multisession"):
+                await storage.delete()
+        finally:
+            await storage.close()
+
+    return {
+        "backend": backend,
+        "storage_version": getattr(storage, "VERSION", None),
+        "peers": peers,
+        "options": options.get(backend, {}),
+        "results": results,
+    }
+
+
+async def main(args) -> Dict[str, Any]:
+    options = parse_options(args.option)
+    options["postgres_url"] = args.postgres_url
+
+    runs = []
+
+    for backend in args.backend:
+        for peers in args.peers:
+            runs.append(await run_backend(backend, peers, args, options))
+
+    versions = {}
+
+    for package in ("pyrogram", "aiosqlite", "sqlalchemy", "cryptography"):
+        try:
+            versions[package] = __import__(package).__version__
+        except (ImportError, AttributeError):
+            versions[package] = None
+
+    arguments = {key: value for key, value in vars(args).items() if key not in ("output", "postgres_url", "option")}
+
+    return {
+        "meta": {
+            "timestamp": int(time.time()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "versions": versions,
+            # Only the host part, credentials stay out of the results
+            "postgres": args.postgres_url.rpartition("@")[2] if args.postgres_url else "sqlite",
+            "arguments": arguments,
+        },
+        "runs": runs,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Benchmark pyrogram storages")
+    parser.add_argument("-b", "--backend", nargs="+", choices=list(BACKENDS))
+    parser.add_argument("-p", "--peers", nargs="+", type=int, default=[10_000])
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=10, help="open/close cycles")
+    parser.add_argument("--lookups", type=int, default=10_000)
+    parser.add_argument("--mix", default="id=80,username=15,phone_number=5", help="lookup ratios")
+    parser.add_argument("--miss-ratio", type=float, default=0.05)
+    parser.add_argument("--states", type=int, default=10_000, help="update_state writes")
+    parser.add_argument("--channels", type=int, default=200)
+    parser.add_argument("--accessors", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--postgres-url", help="SQLAlchemy URL for MultiPostgresStorage (default: SQLite file)")
+    parser.add_argument(
+        "-o", "--option", action="append", default=[], metavar="BACKEND.NAME=VALUE",
+        help="extra storage argument, e.g. aiosqlite.write_behind=True",
+    )
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("-v", "--verbose", action="store_true")
+
+    args = parser.parse_args(argv)
+
+    if args.backend is None:
+        # asyncpg has no SQLite stand-in
+        args.backend = [backend for backend in BACKENDS if args.postgres_url or backend != "asyncpg_multisession"]
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr)
+
+    report = asyncio.run(main(args))
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    else:
+        print(output)
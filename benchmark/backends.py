@@ -0,0 +1,101 @@
+import importlib.util
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Modules the storages import from next to their storage.py
+SHARED = ("sqltrace", "pg_migrations")
+
+_modules = {}  # type: Dict[str, Any]
+
+
+def load_storage_module(directory: str):
+    # Every backend is a standalone storage.py, so they are loaded by path under distinct names
+    if directory not in _modules:
+        for shared in SHARED:
+            path = str(ROOT / shared)
+
+            if path not in sys.path:
+                sys.path.append(path)
+
+        name = f"pyrogram_storages_{directory}"
+        spec = importlib.util.spec_from_file_location(name, ROOT / directory / "storage.py")
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        _modules[directory] = module
+
+    return _modules[directory]
+
+
+def make_client(name: str, workdir: Path):
+    # The storages only read these attributes from the client
+    return SimpleNamespace(
+        name=name,
+        workdir=workdir,
+        in_memory=False,
+        session_string=None,
+        api_id=1,
+        test_mode=False,
+        bot_token=None,
+    )
+
+
+async def aiosqlite_backend(name: str, workdir: Path, options: Dict[str, Any]):
+    module = load_storage_module("aiosqlite")
+
+    return module.AIOSQLiteStorage(make_client(name, workdir), **options.get("aiosqlite", {}))
+
+
+async def encrypted_fernet_backend(name: str, workdir: Path, options: Dict[str, Any]):
+    from cryptography.fernet import Fernet
+
+    module = load_storage_module("encrypted_fernet")
+    storage = module.AIOSQLiteStorage(make_client(name, workdir), **options.get("encrypted_fernet", {}))
+    storage.fernet = Fernet(Fernet.generate_key())
+
+    return storage
+
+
+async def telethon_backend(name: str, workdir: Path, options: Dict[str, Any]):
+    module = load_storage_module("telethon")
+
+    return module.TelethonStorage(client=make_client(name, workdir), **options.get("telethon", {}))
+
+
+async def postgres_multisession_backend(name: str, workdir: Path, options: Dict[str, Any]):
+    client = make_client(name, workdir)
+    storage_options = options.get("postgres_multisession", {})
+
+    if not options.get("postgres_url"):
+        from .postgres_sqlite import SQLitePostgresStorage
+
+        return SQLitePostgresStorage(client, f"sqlite+aiosqlite:///{workdir / 'postgres.db'}", **storage_options)
+
+    module = load_storage_module("postgres_multisession")
+
+    return module.MultiPostgresStorage(client, options["postgres_url"], **storage_options)
+
+
+async def asyncpg_multisession_backend(name: str, workdir: Path, options: Dict[str, Any]):
+    if not options.get("postgres_url"):
+        raise ValueError("asyncpg_multisession needs a Postgres server, pass --postgres-url")
+
+    module = load_storage_module("asyncpg_multisession")
+
+    return module.MultiAsyncpgStorage(
+        make_client(name, workdir), options["postgres_url"], **options.get("asyncpg_multisession", {})
+    )
+
+
+BACKENDS = {
+    "aiosqlite": aiosqlite_backend,
+    "encrypted_fernet": encrypted_fernet_backend,
+    "telethon": telethon_backend,
+    "postgres_multisession": postgres_multisession_backend,
+    "asyncpg_multisession": asyncpg_multisession_backend,
+}  # type: Dict[str, Callable[[str, Path, Dict[str, Any]], Awaitable[Any]]]
+
@@ -0,0 +1,122 @@
+import time
+from typing import List, Tuple
+
+from sqlalchemy import BigInteger, cast, delete, func
+from sqlalchemy.dialects import sqlite
+
+from .backends import load_storage_module
+
+# MultiPostgresStorage writes with Postgres-only SQL (arrays, COPY, advisory locks). Without --postgres-url the
+# benchmark runs it on a SQLite file with these writes swapped for SQLite ones, which only shows the cost of the
+# ORM code around them.
+postgres = load_storage_module("postgres_multisession")
+
+UPSERT_CHUNK_SIZE = 1000
+
+
+class SQLiteEngineRegistry(postgres.EngineRegistry):
+    async def migrate(self, url: str):
+        if url in self.migrated:
+            return
+
+        async with self.engines[url].begin() as conn:
+            await conn.run_sync(postgres.Base.metadata.create_all)
+            await conn.execute(
+                sqlite.insert(postgres.MigrationModel.__table__)
+                .values(version=len(postgres.MIGRATIONS), applied_on=int(time.time()))
+                .on_conflict_do_nothing()
+            )
+
+        self.migrated.add(url)
+
+
+engines = SQLiteEngineRegistry()
+
+
+class SQLitePostgresStorage(postgres.MultiPostgresStorage):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, registry=engines, **kwargs)
+
+    async def update_peers(self, peers: List[Tuple[int, int, str, str]]):
+        peers = list({peer[0]: peer for peer in peers}.values())
+
+        if not peers:
+            return
+
+        stmt = sqlite.insert(postgres.PeerModel.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[postgres.PeerModel.session_name, postgres.PeerModel.id],
+            set_={
+                "access_hash": stmt.excluded.access_hash,
+                "type": stmt.excluded.type,
+                "phone_number": stmt.excluded.phone_number,
+                "last_update_on": stmt.excluded.last_update_on,
+            }
+        )
+
+        async with self.session_maker() as session:
+            for i in range(0, len(peers), UPSERT_CHUNK_SIZE):
+                await session.execute(stmt.values([
+                    {
+                        "session_name": self.name,
+                        "id": peer_id,
+                        "access_hash": access_hash,
+                        "type": peer_type,
+                        "phone_number": phone_number,
+                        "last_update_on": cast(func.strftime("%s", "now"), BigInteger),
+                    }
+                    for peer_id, access_hash, peer_type, phone_number in peers[i:i + UPSERT_CHUNK_SIZE]
+                ]))
+
+            await session.commit()
+
+    async def update_usernames(self, usernames: List[Tuple[int, List[str]]]):
+        usernames = {telegram_id: user_list for telegram_id, user_list in usernames}
+
+        if not usernames:
+            return
+
+        ids = list(usernames)
+        rows = [(telegram_id, username) for telegram_id, user_list in usernames.items() for username in user_list]
+        model = postgres.UsernameModel
+
+        async with self.session_maker() as session:
+            for i in range(0, len(ids), UPSERT_CHUNK_SIZE):
+                await session.execute(
+                    delete(model).where(model.session_name == self.name, model.id.in_(ids[i:i + UPSERT_CHUNK_SIZE]))
+                )
+
+            for i in range(0, len(rows), UPSERT_CHUNK_SIZE):
+                await session.execute(
+                    sqlite.insert(model.__table__)
+                    .values([
+                        {"session_name": self.name, "id": telegram_id, "username": username}
+                        for telegram_id, username in rows[i:i + UPSERT_CHUNK_SIZE]
+                    ])
+                    .on_conflict_do_nothing()
+                )
+
+            await session.commit()
+
+    async def _write_state(self, session, value):
+        if isinstance(value, int):
+            return await super()._write_state(session, value)
+
+        model = postgres.UpdateStateModel
+        stmt = sqlite.insert(model.__table__).values(
+            session_name=self.name,
+            id=value[0],
+            pts=value[1],
+            qts=value[2],
+            date=value[3],
+            seq=value[4]
+        )
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[model.session_name, model.id],
+            set_={
+                "pts": stmt.excluded.pts,
+                "qts": stmt.excluded.qts,
+                "date": stmt.excluded.date,
+                "seq": stmt.excluded.seq,
+            }
+        ))
@@ -0,0 +1,239 @@
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+PEER_TYPES = ("user", "user", "user", "user", "bot", "group", "channel", "supergroup")
+LOOKUP_KINDS = ("id", "username", "phone_number")
+ACCESSORS = ("dc_id", "api_id", "test_mode", "auth_key", "date", "user_id", "is_bot")
+
+
+class Dataset:
+    def __init__(self, count: int, seed: int):
+        rng = random.Random(seed)
+
+        self.peers = []  # type: List[Tuple[int, int, str, Optional[str]]]
+        self.usernames = []  # type: List[Tuple[int, List[str]]]
+        self.ids = []  # type: List[int]
+        self.phone_numbers = []  # type: List[str]
+        self.names = []  # type: List[str]
+
+        for i in range(count):
+            peer_type = rng.choice(PEER_TYPES)
+            access_hash = rng.getrandbits(63)
+            phone_number = None
+
+            if peer_type in ("user", "bot"):
+                peer_id = 1_000_000 + i
+
+                if peer_type == "user":
+                    phone_number = f"7{900_000_000 + i}"
+                    self.phone_numbers.append(phone_number)
+            elif peer_type == "group":
+                peer_id = -(1_000_000 + i)
+            else:
+                peer_id = -1_000_000_000_000 - (1_000_000 + i)
+
+            self.peers.append((peer_id, access_hash, peer_type, phone_number))
+            self.ids.append(peer_id)
+
+            if peer_type != "group":
+                self.usernames.append((peer_id, [f"bench_{i}"]))
+                self.names.append(f"bench_{i}")
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    weights = {}
+
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+
+        if kind not in LOOKUP_KINDS:
+            raise ValueError(f"Unknown lookup kind: {kind}")
+
+        weights[kind] = float(weight)
+
+    total = sum(weights.values())
+
+    if total <= 0:
+        raise ValueError(f"Invalid lookup mix: {mix}")
+
+    return {kind: weight / total for kind, weight in weights.items()}
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(workload: str, operations: int, seconds: float, latencies: Optional[List[float]] = None, **extra):
+    result = {
+        "workload": workload,
+        "operations": operations,
+        "seconds": round(seconds, 6),
+        "ops_per_sec": round(operations / seconds, 2) if seconds else None,
+    }
+
+    if latencies:
+        result["latency_us"] = {
+            "p50": round(percentile(latencies, 0.50) * 1e6, 2),
+            "p95": round(percentile(latencies, 0.95) * 1e6, 2),
+            "p99": round(percentile(latencies, 0.99) * 1e6, 2),
+            "max": round(max(latencies) * 1e6, 2),
+        }
+
+    result.update(extra)
+
+    return result
+
+
+async def create(storage) -> Dict[str, Any]:
+    start = time.perf_counter()
+    await storage.open()
+
+    return summarize("create", 1, time.perf_counter() - start)
+
+
+async def update_peers(storage, dataset: Dataset, batch_size: int) -> Dict[str, Any]:
+    latencies = []
+    start = time.perf_counter()
+
+    for i in range(0, len(dataset.peers), batch_size):
+        batch_start = time.perf_counter()
+        await storage.update_peers(dataset.peers[i:i + batch_size])
+        latencies.append(time.perf_counter() - batch_start)
+
+    for i in range(0, len(dataset.usernames), batch_size):
+        await storage.update_usernames(dataset.usernames[i:i + batch_size])
+
+    await storage.save()
+
+    return summarize(
+        "update_peers",
+        len(dataset.peers),
+        time.perf_counter() - start,
+        latencies,
+        batch_size=batch_size,
+        usernames=len(dataset.usernames),
+    )
+
+
+async def open_close(storage, repeat: int) -> Dict[str, Any]:
+    await storage.close()
+
+    opens = []
+    closes = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await storage.open()
+        opens.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await storage.close()
+        closes.append(time.perf_counter() - start)
+
+    await storage.open()
+
+    return summarize(
+        "open_close",
+        repeat,
+        sum(opens) + sum(closes),
+        [o + c for o, c in zip(opens, closes)],
+        open_us=round(sum(opens) / repeat * 1e6, 2),
+        close_us=round(sum(closes) / repeat * 1e6, 2),
+    )
+
+
+async def lookups(storage, dataset: Dataset, count: int, mix: Dict[str, float], miss_ratio: float, seed: int):
+    rng = random.Random(seed)
+    pools = {"id": dataset.ids, "username": dataset.names, "phone_number": dataset.phone_numbers}
+    kinds = [kind for kind in mix if pools[kind]]
+    operations = []
+
+    for _ in range(count):
+        kind = rng.choices(kinds, weights=[mix[kind] for kind in kinds])[0]
+
+        if rng.random() < miss_ratio:
+            key = {"id": -1, "username": "bench_missing", "phone_number": "0"}[kind]
+        else:
+            key = rng.choice(pools[kind])
+
+        operations.append((getattr(storage, f"get_peer_by_{kind}"), key))
+
+    latencies = []
+    misses = 0
+    start = time.perf_counter()
+
+    for method, key in operations:
+        op_start = time.perf_counter()
+
+        try:
+            await method(key)
+        except KeyError:
+            misses += 1
+
+        latencies.append(time.perf_counter() - op_start)
+
+    return summarize(
+        "lookups",
+        count,
+        time.perf_counter() - start,
+        latencies,
+        mix={kind: round(mix[kind], 4) for kind in kinds},
+        misses=misses,
+    )
+
+
+async def update_state(storage, count: int, channels: int, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    pts = {}  # type: Dict[int, int]
+    latencies = []
+    now = int(time.time())
+    start = time.perf_counter()
+
+    for i in range(count):
+        channel_id = -1_000_000_000_000 - rng.randrange(channels)
+        op_start = time.perf_counter()
+
+        # Channels occasionally drop out of the state, as when the client leaves them
+        if rng.random() < 0.01:
+            pts.pop(channel_id, None)
+            await storage.update_state(channel_id)
+        else:
+            pts[channel_id] = pts.get(channel_id, 0) + rng.randint(1, 5)
+            await storage.update_state((channel_id, pts[channel_id], 0, now + i, 0))
+
+        latencies.append(time.perf_counter() - op_start)
+
+    states = await storage.update_state()
+    await storage.save()
+
+    return summarize(
+        "update_state",
+        count,
+        time.perf_counter() - start,
+        latencies,
+        channels=channels,
+        states=len(states),
+    )
+
+
+async def accessors(storage, count: int) -> Dict[str, Any]:
+    await storage.auth_key(os.urandom(256))
+    await storage.save()
+
+    latencies = []
+    start = time.perf_counter()
+
+    for i in range(count):
+        op_start = time.perf_counter()
+        await getattr(storage, ACCESSORS[i % len(ACCESSORS)])()
+        latencies.append(time.perf_counter() - op_start)
+
+    return summarize("accessors", count, time.perf_counter() - start, latencies)
@@ -1,9 +1,11 @@
+import asyncio
 import base64
 import logging
+import sqlite3
 import struct
 import time
 from pathlib import Path
-from typing import Any, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from pyrogram import Client, raw, utils
 from pyrogram.storage import Storage
@@ -12,6 +14,9 @@ import aiosqlite
 
 log = logging.getLogger(__name__)
 
+# SQLite binds up to 32766 parameters per statement since 3.32.0, and 999 before
+MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
 
 # language=SQLite
 SCHEMA = """
@@ -135,11 +140,17 @@ class AIOSQLiteStorage(Storage):
     VERSION = 7
     USERNAME_TTL = 8 * 60 * 60
     FILE_EXTENSION = ".session"
+    INCREMENTAL_VACUUM_PAGES = 1024
+    QUERY_CHUNK_SIZE = MAX_VARIABLES
 
     def __init__(
         self,
         client: Client,
         use_wal: Optional[bool] = False,
+        auto_vacuum: Optional[bool] = False,
+        vacuum_threshold: Optional[float] = 0.25,
+        maintenance_interval: Optional[float] = 60 * 60,
+        trace_threshold: Optional[float] = None,
     ):
         super().__init__(client.name)
 
@@ -148,12 +159,35 @@ class AIOSQLiteStorage(Storage):
         self.session_string = client.session_string
         self.in_memory = client.in_memory
         self.use_wal = use_wal
+        self.auto_vacuum = auto_vacuum
+        self.vacuum_threshold = vacuum_threshold
+        self.maintenance_interval = maintenance_interval
+
+        self.maintenance_task = None  # type: Optional[asyncio.Task]
+        # Held by writes and by maintenance(), so no write opens a transaction between its commit and VACUUM
+        self._write_lock = asyncio.Lock()
 
         if self.in_memory:
             self.database = ":memory:"
         else:
             self.database = client.workdir / (client.name + self.FILE_EXTENSION)
 
+        self.tracer = None  # type: Optional["SQLTracer"]
+
+        if trace_threshold is not None:
+            # sqltrace.py has to be copied next to this file, see sqltrace/README.md
+            from sqltrace import SQLTracer
+
+            self.tracer = SQLTracer(trace_threshold, None if self.in_memory else str(self.database))
+
+    async def connect(self, database: str):
+        conn = await aiosqlite.connect(database, timeout=1, check_same_thread=False)
+
+        if self.tracer is not None:
+            await self.tracer.attach_async(conn)
+
+        return conn
+
     async def update(self):
         version = await self.version()
 
@@ -203,6 +237,9 @@ class AIOSQLiteStorage(Storage):
         await self.conn.commit()
 
     async def create(self):
+        if self.auto_vacuum:
+            await self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
         await self.conn.executescript(SCHEMA)
 
         await self.conn.execute("INSERT INTO version VALUES (?)", (self.VERSION,))
@@ -216,7 +253,7 @@ class AIOSQLiteStorage(Storage):
 
     async def open(self):
         if self.in_memory:
-            self.conn = await aiosqlite.connect(":memory:", timeout=1, check_same_thread=False)
+            self.conn = await self.connect(":memory:")
             await self.create()
 
             if self.session_string:
@@ -276,7 +313,7 @@ class AIOSQLiteStorage(Storage):
         path = self.database
         file_exists = isinstance(path, Path) and path.is_file()
 
-        self.conn = await aiosqlite.connect(str(path), timeout=1, check_same_thread=False)
+        self.conn = await self.connect(str(path))
 
         if self.use_wal:
             await self.conn.execute("PRAGMA journal_mode=WAL")
@@ -288,32 +325,87 @@ class AIOSQLiteStorage(Storage):
         else:
             await self.create()
 
-        await self.conn.execute("VACUUM")
         await self.conn.commit()
 
+        if self.maintenance_interval is not None:
+            self.maintenance_task = asyncio.create_task(self.maintenance_worker())
+
     async def save(self):
         await self.date(int(time.time()))
-        await self.conn.commit()
+
+        async with self._write_lock:
+            await self.conn.commit()
+
+    async def maintenance(self):
+        async with self._write_lock:
+            auto_vacuum = (await (await self.conn.execute("PRAGMA auto_vacuum")).fetchone())[0]
+            page_count = (await (await self.conn.execute("PRAGMA page_count")).fetchone())[0]
+            freelist_count = (await (await self.conn.execute("PRAGMA freelist_count")).fetchone())[0]
+
+            # VACUUM can't run inside a transaction
+            await self.conn.commit()
+
+            if self.auto_vacuum and auto_vacuum != 2:
+                log.info("Converting %s to incremental auto vacuum", self.database)
+
+                await self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                await self.conn.execute("VACUUM")
+            elif auto_vacuum == 2 and freelist_count:
+                # sqlite3 steps a statement only once per execute(), which frees a single page
+                await self.conn.executescript(f"PRAGMA incremental_vacuum({self.INCREMENTAL_VACUUM_PAGES});")
+            elif self.vacuum_threshold is not None and page_count and freelist_count / page_count >= self.vacuum_threshold:
+                log.info("Vacuuming %s (%s of %s pages free)", self.database, freelist_count, page_count)
+
+                await self.conn.execute("VACUUM")
+
+            await self.conn.execute("PRAGMA optimize")
+
+    async def maintenance_worker(self):
+        while True:
+            # The first pass waits as well, a VACUUM right after open() would hold up every query
+            await asyncio.sleep(self.maintenance_interval)
+
+            try:
+                await self.maintenance()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Storage maintenance failed: %s", e)
 
     async def close(self):
+        if self.maintenance_task is not None:
+            self.maintenance_task.cancel()
+
+            try:
+                await self.maintenance_task
+            except asyncio.CancelledError:
+                pass
+
+            self.maintenance_task = None
+
         await self.conn.close()
 
+        if self.tracer is not None:
+            self.tracer.close()
+
     async def delete(self):
         if not self.in_memory:
             Path(self.database).unlink()
 
     async def update_peers(self, peers: List[Tuple[int, int, str, str]]):
-        await self.conn.executemany(
-            "REPLACE INTO peers (id, access_hash, type, phone_number) VALUES (?, ?, ?, ?)", peers
-        )
+        async with self._write_lock:
+            await self.conn.executemany(
+                "REPLACE INTO peers (id, access_hash, type, phone_number) VALUES (?, ?, ?, ?)", peers
+            )
 
     async def update_usernames(self, usernames: List[Tuple[int, List[str]]]):
-        await self.conn.executemany("DELETE FROM usernames WHERE id = ?", [(id,) for id, _ in usernames])
+        async with self._write_lock:
+            await self.conn.executemany("DELETE FROM usernames WHERE id = ?", [(id,) for id, _ in usernames])
 
-        await self.conn.executemany(
-            "REPLACE INTO usernames (id, username) VALUES (?, ?)",
-            [(id, username) for id, usernames in usernames for username in usernames],
-        )
+            await self.conn.executemany(
+                "REPLACE INTO usernames (id, username) VALUES (?, ?)",
+                [(id, username) for id, usernames in usernames for username in usernames],
+            )
 
     async def update_state(self, value: Tuple[int, int, int, int, int] = object):
         if value is object:
@@ -323,13 +415,14 @@ class AIOSQLiteStorage(Storage):
 
             return await r.fetchall()
         else:
-            if isinstance(value, int):
-                await self.conn.execute("DELETE FROM update_state WHERE id = ?", (value,))
-            else:
-                await self.conn.execute(
-                    "REPLACE INTO update_state (id, pts, qts, date, seq) VALUES (?, ?, ?, ?, ?)",
-                    value,
-                )
+            async with self._write_lock:
+                if isinstance(value, int):
+                    await self.conn.execute("DELETE FROM update_state WHERE id = ?", (value,))
+                else:
+                    await self.conn.execute(
+                        "REPLACE INTO update_state (id, pts, qts, date, seq) VALUES (?, ?, ?, ?, ?)",
+                        value,
+                    )
 
     async def get_peer_by_id(self, peer_id: int):
         r = await (await self.conn.execute(
@@ -370,14 +463,56 @@ class AIOSQLiteStorage(Storage):
 
         return get_input_peer(*r)
 
+    async def get_peers_by_ids(self, ids: List[int]) -> Tuple[Dict[int, Any], List[int]]:
+        ids = list(dict.fromkeys(ids))
+        peers = {}
+
+        for i in range(0, len(ids), self.QUERY_CHUNK_SIZE):
+            chunk = ids[i:i + self.QUERY_CHUNK_SIZE]
+
+            rows = await (await self.conn.execute(
+                f"SELECT id, access_hash, type FROM peers WHERE id IN ({', '.join('?' * len(chunk))})",
+                chunk
+            )).fetchall()
+
+            for r in rows:
+                peers[r[0]] = get_input_peer(*r)
+
+        return peers, [peer_id for peer_id in ids if peer_id not in peers]
+
+    async def get_peers_by_usernames(self, usernames: List[str]) -> Tuple[Dict[str, Any], List[str]]:
+        usernames = list(dict.fromkeys(usernames))
+        peers = {}
+
+        for i in range(0, len(usernames), self.QUERY_CHUNK_SIZE):
+            chunk = usernames[i:i + self.QUERY_CHUNK_SIZE]
+
+            rows = await (await self.conn.execute(
+                "SELECT u.username, p.id, p.access_hash, p.type, p.last_update_on FROM peers p "
+                "JOIN usernames u ON p.id = u.id "
+                f"WHERE u.username IN ({', '.join('?' * len(chunk))}) "
+                "ORDER BY p.last_update_on ASC",
+                chunk
+            )).fetchall()
+
+            # Rows are ordered by date, so the most recently updated peer wins
+            latest = {r[0]: r[1:] for r in rows}
+
+            for username, r in latest.items():
+                if abs(time.time() - r[3]) <= self.USERNAME_TTL:
+                    peers[username] = get_input_peer(*r[:3])
+
+        return peers, [username for username in usernames if username not in peers]
+
     async def _get(self, table: str, attr: str):
         r = await self.conn.execute(f"SELECT {attr} FROM {table}")
 
         return (await r.fetchone())[0]
 
     async def _set(self, table: str, attr: str, value: Any):
-        await self.conn.execute(f"UPDATE {table} SET {attr} = ?", (value,))
-        await self.conn.commit()
+        async with self._write_lock:
+            await self.conn.execute(f"UPDATE {table} SET {attr} = ?", (value,))
+            await self.conn.commit()
 
     async def _accessor(self, table: str, attr: str, value: Any = object):
         return await self._get(table, attr) if value is object else await self._set(table, attr, value)
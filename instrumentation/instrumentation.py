@@ -0,0 +1,243 @@
+import logging
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+METHODS = (
+    "open",
+    "save",
+    "close",
+    "delete",
+    "update_peers",
+    "update_usernames",
+    "update_state",
+    "get_peer_by_id",
+    "get_peer_by_username",
+    "get_peer_by_phone_number",
+    "get_peers_by_ids",
+    "get_peers_by_usernames",
+    "dc_id",
+    "server_address",
+    "port",
+    "api_id",
+    "test_mode",
+    "auth_key",
+    "date",
+    "user_id",
+    "is_bot",
+    "version",
+)
+
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+# callback(session, method, duration, rows, error)
+Callback = Callable[[str, str, float, Optional[int], Optional[BaseException]], None]
+
+
+# Name of the first parameter of the methods whose rows are counted from their arguments
+ARGUMENTS = {
+    "update_peers": "peers",
+    "update_usernames": "usernames",
+    "update_state": "value",
+}
+
+
+def count_rows(method: str, args: tuple, kwargs: dict, result: Any) -> Optional[int]:
+    # Metrics must never break the storage call they describe
+    try:
+        if method in ARGUMENTS:
+            if args:
+                value = args[0]
+            elif ARGUMENTS[method] in kwargs:
+                value = kwargs[ARGUMENTS[method]]
+            elif method == "update_state":
+                return len(result)
+            else:
+                return None
+
+            return 1 if method == "update_state" else len(value)
+
+        if method in ("get_peers_by_ids", "get_peers_by_usernames"):
+            return len(result[0])
+
+        if method.startswith("get_peer_by_"):
+            return 1
+    except Exception:
+        return None
+
+    return None
+
+
+def report(callback: Callback, *values):
+    # A failing callback is logged, it must neither fail a storage call nor replace its exception
+    try:
+        callback(*values)
+    except Exception:
+        log.exception("Storage metrics callback failed")
+
+
+def wrap(session: str, method: str, func, callback: Callback):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = perf_counter()
+
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            report(callback, session, method, perf_counter() - start, None, e)
+            raise
+
+        report(callback, session, method, perf_counter() - start, count_rows(method, args, kwargs, result), None)
+
+        return result
+
+    return wrapper
+
+
+def instrument(storage, callback: Callback, methods: Iterable[str] = METHODS):
+    # Wrappers are stored on the instance and shadow the class methods, so an uninstrumented storage
+    # runs exactly the original code
+    uninstrument(storage)
+
+    instrumented = []
+
+    for method in methods:
+        if getattr(type(storage), method, None) is None:
+            continue
+
+        setattr(storage, method, wrap(storage.name, method, getattr(storage, method), callback))
+        instrumented.append(method)
+
+    storage._instrumented = tuple(instrumented)
+
+    return storage
+
+
+def uninstrument(storage):
+    for method in storage.__dict__.pop("_instrumented", ()):
+        storage.__dict__.pop(method, None)
+
+    return storage
+
+
+class MethodStats:
+    __slots__ = ("buckets", "count", "sum", "rows", "errors")
+
+    def __init__(self, size: int):
+        self.buckets = [0] * (size + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.rows = 0
+        self.errors = {}  # type: Dict[str, int]
+
+
+class LatencyCollector:
+    def __init__(self, buckets: Iterable[float] = BUCKETS, prefix: str = "pyrogram_storage"):
+        self.buckets = tuple(sorted(buckets))
+        self.prefix = prefix
+        self.stats = {}  # type: Dict[Tuple[str, str], MethodStats]
+
+    def __call__(self, session: str, method: str, duration: float, rows: Optional[int], error: Optional[BaseException]):
+        stats = self.stats.get((session, method))
+
+        if stats is None:
+            stats = self.stats[session, method] = MethodStats(len(self.buckets))
+
+        stats.buckets[bisect_left(self.buckets, duration)] += 1
+        stats.count += 1
+        stats.sum += duration
+
+        if rows:
+            stats.rows += rows
+
+        if error is not None:
+            name = type(error).__name__
+            stats.errors[name] = stats.errors.get(name, 0) + 1
+
+    def reset(self):
+        self.stats.clear()
+
+    def cumulative(self, stats: MethodStats):
+        total = 0
+
+        for le, count in zip(self.buckets, stats.buckets):
+            total += count
+            yield le, total
+
+    def render(self) -> str:
+        duration = f"{self.prefix}_call_duration_seconds"
+        lines = [
+            f"# HELP {duration} Time spent in storage methods.",
+            f"# TYPE {duration} histogram",
+        ]
+
+        for (session, method), stats in sorted(self.stats.items()):
+            labels = f'session="{escape(session)}",method="{method}"'
+
+            for le, total in self.cumulative(stats):
+                lines.append(f'{duration}_bucket{{{labels},le="{le}"}} {total}')
+
+            lines.append(f'{duration}_bucket{{{labels},le="+Inf"}} {stats.count}')
+            lines.append(f"{duration}_sum{{{labels}}} {stats.sum}")
+            lines.append(f"{duration}_count{{{labels}}} {stats.count}")
+
+        lines.append(f"# HELP {self.prefix}_rows_total Rows passed to or returned by storage methods.")
+        lines.append(f"# TYPE {self.prefix}_rows_total counter")
+
+        for (session, method), stats in sorted(self.stats.items()):
+            lines.append(f'{self.prefix}_rows_total{{session="{escape(session)}",method="{method}"}} {stats.rows}')
+
+        lines.append(f"# HELP {self.prefix}_errors_total Exceptions raised by storage methods.")
+        lines.append(f"# TYPE {self.prefix}_errors_total counter")
+
+        for (session, method), stats in sorted(self.stats.items()):
+            for error, count in sorted(stats.errors.items()):
+                lines.append(
+                    f'{self.prefix}_errors_total{{session="{escape(session)}",method="{method}",error="{error}"}} {count}'
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def collect(self):
+        # For prometheus_client: REGISTRY.register(collector)
+        from prometheus_client.core import CounterMetricFamily, HistogramMetricFamily
+
+        duration = HistogramMetricFamily(
+            f"{self.prefix}_call_duration_seconds",
+            "Time spent in storage methods.",
+            labels=["session", "method"],
+        )
+        rows = CounterMetricFamily(
+            f"{self.prefix}_rows",
+            "Rows passed to or returned by storage methods.",
+            labels=["session", "method"],
+        )
+        errors = CounterMetricFamily(
+            f"{self.prefix}_errors",
+            "Exceptions raised by storage methods.",
+            labels=["session", "method", "error"],
+        )
+
+        for (session, method), stats in self.stats.items():
+            duration.add_metric(
+                [session, method],
+                buckets=[(str(le), total) for le, total in self.cumulative(stats)] + [("+Inf", stats.count)],
+                sum_value=stats.sum,
+            )
+            rows.add_metric([session, method], stats.rows)
+
+            for error, count in stats.errors.items():
+                errors.add_metric([session, method, error], count)
+
+        yield duration
+        yield rows
+        yield errors
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,284 @@
+import base64
+import logging
+import struct
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from pyrogram import Client, raw, utils
+from pyrogram.storage import Storage
+
+log = logging.getLogger(__name__)
+
+TEST = {
+    1: "149.154.175.10",
+    2: "149.154.167.40",
+    3: "149.154.175.117"
+}
+
+PROD = {
+    1: "149.154.175.53",
+    2: "149.154.167.51",
+    3: "149.154.175.100",
+    4: "149.154.167.91",
+    5: "91.108.56.130",
+    203: "91.105.192.100"
+}
+
+def get_input_peer(peer_id: int, access_hash: int, peer_type: str):
+    if peer_type in ["user", "bot"]:
+        return raw.types.InputPeerUser(
+            user_id=peer_id,
+            access_hash=access_hash
+        )
+
+    if peer_type == "group":
+        return raw.types.InputPeerChat(
+            chat_id=-peer_id
+        )
+
+    if peer_type in ["direct", "channel", "forum", "supergroup"]:
+        return raw.types.InputPeerChannel(
+            channel_id=utils.get_channel_id(peer_id),
+            access_hash=access_hash
+        )
+
+    raise ValueError(f"Invalid peer type: {peer_type}")
+
+
+class MemoryStorage(Storage):
+    VERSION = 1
+    USERNAME_TTL = 8 * 60 * 60
+
+    def __init__(self, client: Client):
+        super().__init__(client.name)
+
+        self.session_string = client.session_string
+
+        self.session = {}  # type: Dict[str, Any]
+        # id -> (id, access_hash, type, phone_number, last_update_on)
+        self.peers = {}  # type: Dict[int, Tuple[int, int, str, str, int]]
+        self.usernames = {}  # type: Dict[int, Tuple[str, ...]]
+        self.states = {}  # type: Dict[int, Tuple[int, int, int, int, int]]
+
+        # A username can be stored for several peers, like in the SQLite storages
+        self._username_ids = {}  # type: Dict[str, Set[int]]
+        self._phone_number_ids = {}  # type: Dict[str, int]
+
+    async def open(self):
+        self.session = {
+            "dc_id": 2,
+            "server_address": "149.154.167.51",
+            "port": 443,
+            "api_id": None,
+            "test_mode": None,
+            "auth_key": None,
+            "date": 0,
+            "user_id": None,
+            "is_bot": None,
+        }
+
+        if not self.session_string:
+            return
+
+        # Old format
+        if len(self.session_string) in [
+            self.SESSION_STRING_SIZE,
+            self.SESSION_STRING_SIZE_64,
+        ]:
+            dc_id, test_mode, auth_key, user_id, is_bot = struct.unpack(
+                (
+                    self.OLD_SESSION_STRING_FORMAT
+                    if len(self.session_string) == self.SESSION_STRING_SIZE
+                    else self.OLD_SESSION_STRING_FORMAT_64
+                ),
+                base64.urlsafe_b64decode(
+                    self.session_string + "=" * (-len(self.session_string) % 4)
+                ),
+            )
+
+            self.session.update(
+                dc_id=dc_id,
+                test_mode=test_mode,
+                auth_key=auth_key,
+                user_id=user_id,
+                is_bot=is_bot,
+                date=0,
+            )
+
+            log.warning(
+                "You are using an old session string format. Use export_session_string to update"
+            )
+            return
+
+        dc_id, api_id, test_mode, auth_key, user_id, is_bot = struct.unpack(
+            self.SESSION_STRING_FORMAT,
+            base64.urlsafe_b64decode(
+                self.session_string + "=" * (-len(self.session_string) % 4)
+            ),
+        )
+
+        self.session.update(
+            dc_id=dc_id,
+            server_address=TEST[dc_id] if test_mode else PROD[dc_id],
+            port=80 if test_mode else 443,
+            api_id=api_id,
+            test_mode=test_mode,
+            auth_key=auth_key,
+            user_id=user_id,
+            is_bot=is_bot,
+            date=0,
+        )
+
+    async def save(self):
+        await self.date(int(time.time()))
+
+    async def close(self):
+        pass
+
+    async def delete(self):
+        self.session.clear()
+        self.peers.clear()
+        self.usernames.clear()
+        self.states.clear()
+        self._username_ids.clear()
+        self._phone_number_ids.clear()
+
+    async def update_peers(self, peers: List[Tuple[int, int, str, str]]):
+        now = int(time.time())
+
+        for peer_id, access_hash, peer_type, phone_number in peers:
+            old = self.peers.get(peer_id)
+
+            if old is not None and self._phone_number_ids.get(old[3]) == peer_id:
+                del self._phone_number_ids[old[3]]
+
+            self.peers[peer_id] = (peer_id, access_hash, peer_type, phone_number, now)
+
+            if phone_number:
+                self._phone_number_ids[phone_number] = peer_id
+
+    async def update_usernames(self, usernames: List[Tuple[int, List[str]]]):
+        for peer_id, names in usernames:
+            for username in self.usernames.pop(peer_id, ()):
+                ids = self._username_ids[username]
+                ids.discard(peer_id)
+
+                if not ids:
+                    del self._username_ids[username]
+
+            if not names:
+                continue
+
+            self.usernames[peer_id] = tuple(names)
+
+            for username in names:
+                self._username_ids.setdefault(username, set()).add(peer_id)
+
+    def _get_by_username(self, username: str) -> Optional[Tuple[int, int, str, str, int]]:
+        # The most recently updated peer wins, as in the SQLite storages
+        return max(
+            (self.peers[peer_id] for peer_id in self._username_ids.get(username, ()) if peer_id in self.peers),
+            key=lambda peer: peer[4],
+            default=None
+        )
+
+    async def update_state(self, value: Tuple[int, int, int, int, int] = object):
+        if value is object:
+            return sorted(self.states.values(), key=lambda state: state[3])
+        else:
+            if isinstance(value, int):
+                self.states.pop(value, None)
+            else:
+                self.states[value[0]] = tuple(value)
+
+    async def get_peer_by_id(self, peer_id: int):
+        r = self.peers.get(peer_id)
+
+        if r is None:
+            raise KeyError(f"ID not found: {peer_id}")
+
+        return get_input_peer(*r[:3])
+
+    async def get_peer_by_username(self, username: str):
+        r = self._get_by_username(username)
+
+        if r is None:
+            raise KeyError(f"Username not found: {username}")
+
+        if abs(time.time() - r[4]) > self.USERNAME_TTL:
+            raise KeyError(f"Username expired: {username}")
+
+        return get_input_peer(*r[:3])
+
+    async def get_peer_by_phone_number(self, phone_number: str):
+        r = self.peers.get(self._phone_number_ids.get(phone_number))
+
+        if r is None:
+            raise KeyError(f"Phone number not found: {phone_number}")
+
+        return get_input_peer(*r[:3])
+
+    async def get_peers_by_ids(self, ids: List[int]) -> Tuple[Dict[int, Any], List[int]]:
+        peers = {}
+        missing = []
+
+        for peer_id in dict.fromkeys(ids):
+            r = self.peers.get(peer_id)
+
+            if r is None:
+                missing.append(peer_id)
+            else:
+                peers[peer_id] = get_input_peer(*r[:3])
+
+        return peers, missing
+
+    async def get_peers_by_usernames(self, usernames: List[str]) -> Tuple[Dict[str, Any], List[str]]:
+        now = time.time()
+        peers = {}
+        missing = []
+
+        for username in dict.fromkeys(usernames):
+            r = self._get_by_username(username)
+
+            if r is None or abs(now - r[4]) > self.USERNAME_TTL:
+                missing.append(username)
+            else:
+                peers[username] = get_input_peer(*r[:3])
+
+        return peers, missing
+
+    async def _accessor(self, attr: str, value: Any = object):
+        if value is object:
+            return self.session[attr]
+
+        self.session[attr] = value
+
+    async def dc_id(self, value: int = object):
+        return await self._accessor("dc_id", value)
+
+    async def server_address(self, value: str = object):
+        return await self._accessor("server_address", value)
+
+    async def port(self, value: int = object):
+        return await self._accessor("port", value)
+
+    async def api_id(self, value: int = object):
+        return await self._accessor("api_id", value)
+
+    async def test_mode(self, value: bool = object):
+        return await self._accessor("test_mode", value)
+
+    async def auth_key(self, value: bytes = object):
+        return await self._accessor("auth_key", value)
+
+    async def date(self, value: int = object):
+        return await self._accessor("date", value)
+
+    async def user_id(self, value: int = object):
+        return await self._accessor("user_id", value)
+
+    async def is_bot(self, value: bool = object):
+        return await self._accessor("is_bot", value)
+
+    async def version(self, value: int = object):
+        return self.VERSION
@@ -0,0 +1,91 @@
+# Shared by postgres_multisession and asyncpg_multisession, so both storages can work on one database
+
+# Any two storages on the same database take this lock before migrating it
+MIGRATION_LOCK = 7_011_792_346
+
+# language=PostgreSQL
+SCHEMA_MIGRATIONS = """
+CREATE TABLE IF NOT EXISTS schema_migrations
+(
+    version    INTEGER PRIMARY KEY,
+    applied_on BIGINT NOT NULL
+)
+"""
+
+# MIGRATIONS[n - 1] brings the schema from version n - 1 to n. Tables made by hand for older releases are kept as they
+# are, so existing deployments go through the same steps as new ones.
+# language=PostgreSQL
+MIGRATIONS = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS sessions
+        (
+            session_name VARCHAR PRIMARY KEY,
+            dc_id        INTEGER NOT NULL,
+            api_id       INTEGER,
+            test_mode    BOOLEAN,
+            auth_key     BYTEA,
+            date         INTEGER NOT NULL,
+            user_id      BIGINT,
+            is_bot       BOOLEAN
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS peers
+        (
+            session_name   VARCHAR REFERENCES sessions (session_name),
+            id             BIGINT,
+            access_hash    BIGINT,
+            type           VARCHAR,
+            phone_number   VARCHAR,
+            last_update_on BIGINT,
+            PRIMARY KEY (session_name, id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS usernames
+        (
+            session_name VARCHAR,
+            id           BIGINT,
+            username     VARCHAR,
+            PRIMARY KEY (session_name, id, username)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS update_state
+        (
+            id           INTEGER PRIMARY KEY,
+            session_name VARCHAR REFERENCES sessions (session_name),
+            pts          INTEGER,
+            qts          INTEGER,
+            date         INTEGER,
+            seq          INTEGER
+        )
+        """,
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_peers_phone_number ON peers (session_name, phone_number)",
+        "CREATE INDEX IF NOT EXISTS idx_usernames_username ON usernames (session_name, username)",
+    ],
+    [
+        # The old primary key was the channel id alone, so two sessions couldn't keep a state for the same channel
+        """
+        DO $$
+        DECLARE
+            pkey TEXT;
+        BEGIN
+            SELECT conname INTO pkey FROM pg_constraint WHERE conrelid = 'update_state'::regclass AND contype = 'p';
+
+            IF pkey IS NOT NULL THEN
+                EXECUTE format('ALTER TABLE update_state DROP CONSTRAINT %I', pkey);
+            END IF;
+        END
+        $$
+        """,
+        "DELETE FROM update_state WHERE session_name IS NULL",
+        "ALTER TABLE update_state ALTER COLUMN id TYPE BIGINT, ALTER COLUMN session_name SET NOT NULL",
+        "ALTER TABLE update_state ADD PRIMARY KEY (session_name, id)",
+        # Replaced by schema_migrations
+        "DROP TABLE IF EXISTS version",
+    ],
+]
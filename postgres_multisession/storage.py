@@ -1,16 +1,26 @@
+import asyncio
+import logging
 import time
-from typing import Tuple, List, Any
+from contextlib import asynccontextmanager
+from typing import Tuple, List, Any, Dict, Optional, Union
 
 from pyrogram import Client, raw, utils
 from pyrogram.storage import Storage
 from sqlalchemy import (
-    Column, Integer, String, BigInteger, Boolean, ForeignKey, delete, LargeBinary, event
+    Column, Integer, String, BigInteger, Boolean, ForeignKey, delete, LargeBinary, any_, bindparam, func,
+    text, update, Index
 )
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncConnection, AsyncEngine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.future import select
 from sqlalchemy.orm import sessionmaker, relationship, aliased
 
+from pg_migrations import MIGRATION_LOCK, MIGRATIONS, SCHEMA_MIGRATIONS
+
+log = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 
@@ -39,26 +49,28 @@ class PeerModel(Base):
 
     session = relationship("SessionModel", back_populates="peers")
 
-
-@event.listens_for(PeerModel, 'before_update')
-def update_last_update_on(mapper, connection, target):
-    if not target.last_update_on:
-        target.last_update_on = int(time.time())
+    __table_args__ = (
+        Index("idx_peers_phone_number", "session_name", "phone_number"),
+    )
 
 
 class UsernameModel(Base):
     __tablename__ = 'usernames'
 
-    session_name = Column(String, ForeignKey('peers.session_name'), primary_key=True)
-    id = Column(BigInteger, ForeignKey('peers.id'), primary_key=True)
+    session_name = Column(String, primary_key=True)
+    id = Column(BigInteger, primary_key=True)
     username = Column(String, primary_key=True)
 
+    __table_args__ = (
+        Index("idx_usernames_username", "session_name", "username"),
+    )
+
 
 class UpdateStateModel(Base):
     __tablename__ = 'update_state'
 
-    id = Column(Integer, primary_key=True)
-    session_name = Column(String, ForeignKey('sessions.session_name'))
+    session_name = Column(String, ForeignKey('sessions.session_name'), primary_key=True)
+    id = Column(BigInteger, primary_key=True)
     pts = Column(Integer)
     qts = Column(Integer)
     date = Column(Integer)
@@ -68,9 +80,11 @@ class UpdateStateModel(Base):
 SessionModel.peers = relationship("PeerModel", back_populates="session")
 
 
-class VersionModel(Base):
-    __tablename__ = 'version'
-    number = Column(Integer, primary_key=True)
+class MigrationModel(Base):
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True)
+    applied_on = Column(BigInteger, nullable=False)
 
 
 def get_input_peer(peer_id: int, access_hash: int, peer_type: str):
@@ -94,19 +108,131 @@ def get_input_peer(peer_id: int, access_hash: int, peer_type: str):
     raise ValueError(f"Invalid peer type: {peer_type}")
 
 
+UPSERT_PEERS = (
+    "ON CONFLICT (session_name, id) DO UPDATE SET "
+    "access_hash = excluded.access_hash, type = excluded.type, "
+    "phone_number = excluded.phone_number, last_update_on = excluded.last_update_on"
+)
+
+
+async def migrate(conn: AsyncConnection) -> int:
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK})
+    await conn.exec_driver_sql(SCHEMA_MIGRATIONS)
+
+    result = await conn.execute(text("SELECT coalesce(max(version), 0) FROM schema_migrations"))
+    version = result.scalar_one()
+
+    for statements in MIGRATIONS[version:]:
+        for statement in statements:
+            await conn.exec_driver_sql(statement)
+
+        version += 1
+
+        await conn.execute(
+            text("INSERT INTO schema_migrations (version, applied_on) VALUES (:version, extract(epoch FROM now()))"),
+            {"version": version}
+        )
+
+        log.info("Migrated the multi-session schema to version %d", version)
+
+    return version
+
+
+class EngineRegistry:
+    def __init__(
+        self,
+        pool_size: Optional[int] = None,
+        max_overflow: Optional[int] = None,
+        pool_recycle: Optional[int] = None,
+        **kwargs
+    ):
+        options = dict(pool_size=pool_size, max_overflow=max_overflow, pool_recycle=pool_recycle, **kwargs)
+
+        self.options = {name: value for name, value in options.items() if value is not None}
+        self.engines = {}  # type: Dict[str, AsyncEngine]
+        self.references = {}  # type: Dict[str, int]
+        self.migrated = set()
+
+    def acquire(self, url: str) -> AsyncEngine:
+        if url not in self.engines:
+            self.engines[url] = create_async_engine(url, echo=False, **self.options)
+            self.references[url] = 0
+
+        self.references[url] += 1
+
+        return self.engines[url]
+
+    async def release(self, url: str):
+        self.references[url] -= 1
+
+        # The pool is only closed when the last storage using it is gone
+        if not self.references[url]:
+            del self.references[url]
+            await self.engines.pop(url).dispose()
+
+    async def migrate(self, url: str):
+        # Each database is migrated once per process, not on every open()
+        if url in self.migrated:
+            return
+
+        async with self.engines[url].begin() as conn:
+            await migrate(conn)
+
+        self.migrated.add(url)
+
+    async def dispose(self):
+        engines = list(self.engines.values())
+
+        self.engines.clear()
+        self.references.clear()
+        self.migrated.clear()
+
+        for engine in engines:
+            await engine.dispose()
+
+
+engines = EngineRegistry()
+
+
 class MultiPostgresStorage(Storage):
-    VERSION = 1
+    VERSION = len(MIGRATIONS)
     USERNAME_TTL = 8 * 60 * 60
-
-    def __init__(self, client: Client, database: dict):
+    COPY_THRESHOLD = 10_000
+
+    def __init__(
+        self,
+        client: Client,
+        database: Union[dict, str],
+        state_flush_interval: Optional[float] = None,
+        registry: Optional[EngineRegistry] = None,
+        migrate: bool = True,
+    ):
         super().__init__(client.name)
-        db_url = f"postgresql+asyncpg://{database['db_user']}:{database['db_pass']}@{database['db_host']}:{database['db_port']}/{database['db_name']}"
-        self.engine = create_async_engine(db_url, echo=False)
-        self.session_maker = sessionmaker(
-            self.engine, class_=AsyncSession, expire_on_commit=False
-        )
+
+        if isinstance(database, str):
+            self.url = database
+        else:
+            self.url = f"postgresql+asyncpg://{database['db_user']}:{database['db_pass']}@{database['db_host']}:{database['db_port']}/{database['db_name']}"
+
+        self.registry = registry or engines
+        self.migrate = migrate
+        self.engine = None  # type: Optional[AsyncEngine]
+        self.session_maker = None  # type: Optional[sessionmaker]
         self.name = client.name
 
+        self._session = None  # type: Optional[Dict[str, Any]]
+        self._pending_session = {}  # type: Dict[str, Any]
+        self._batch_lock = asyncio.Lock()
+        self._batch_task = None  # type: Optional[asyncio.Task]
+
+        self.acquire_engine()
+
+        self.state_flush_interval = state_flush_interval
+        self.state_task = None  # type: Optional[asyncio.Task]
+
+        self._states = None  # type: Optional[Dict[int, Tuple[int, int, int, int, int]]]
+        self._pending_states = {}  # type: Dict[int, Optional[Tuple[int, int, int, int, int]]]
+
     async def create(self):
         async with self.session_maker() as session:
             session_exists = await session.execute(select(SessionModel).filter_by(session_name=self.name))
@@ -115,7 +241,7 @@ class MultiPostgresStorage(Storage):
             if not session_exists:
                 new_session = SessionModel(
                     session_name=self.name,
-                    dc_id=None,
+                    dc_id=2,
                     api_id=None,
                     test_mode=None,
                     auth_key=None,
@@ -126,24 +252,129 @@ class MultiPostgresStorage(Storage):
                 session.add(new_session)
                 await session.commit()
 
+    def acquire_engine(self):
+        if self.engine is None:
+            self.engine = self.registry.acquire(self.url)
+            self.session_maker = sessionmaker(
+                self.engine, class_=AsyncSession, expire_on_commit=False
+            )
+
+    async def release_engine(self):
+        if self.engine is not None:
+            self.engine = self.session_maker = None
+            await self.registry.release(self.url)
+
     async def open(self):
+        self.acquire_engine()
+
+        if self.migrate:
+            await self.registry.migrate(self.url)
+
         async with self.session_maker() as session:
             session_exists = await session.execute(select(SessionModel).filter_by(session_name=self.name))
             session_exists = session_exists.scalar()
             if not session_exists:
                 await self.create()
 
-    async def save(self):
+        await self.load_session()
+
+        if self.state_flush_interval is not None:
+            await self.load_states()
+            self.state_task = asyncio.create_task(self.state_worker())
+
+    async def load_session(self):
+        async with self.session_maker() as session:
+            result = await session.execute(
+                select(*SessionModel.__table__.columns).filter_by(session_name=self.name)
+            )
+            row = result.one()
+
+        self._session = dict(row._mapping)
+
+    @asynccontextmanager
+    async def batch(self):
+        # A nested batch of the same task is part of the outer one
+        if self._batch_task is asyncio.current_task():
+            yield self
+            return
+
+        # Accessor writes of other tasks wait instead of joining this batch, so a failed batch only drops its own writes
+        async with self._batch_lock:
+            self._batch_task = asyncio.current_task()
+
+            try:
+                yield self
+            except BaseException:
+                self._pending_session.clear()
+
+                if self._session is not None:
+                    await self.load_session()
+
+                raise
+            else:
+                await self.flush_session()
+            finally:
+                self._batch_task = None
+
+    async def flush_session(self):
+        if not self._pending_session:
+            return
+
+        values = self._pending_session
+        self._pending_session = {}
+
+        await self._update_session(values)
+
+    async def _update_session(self, values: Dict[str, Any]):
         async with self.session_maker() as session:
-            await self.date(int(time.time()))
+            result = await session.execute(
+                update(SessionModel).where(SessionModel.session_name == self.name).values(**values)
+            )
+
+            if not result.rowcount:
+                raise ValueError(f"Session with name {self.name} not found.")
+
             await session.commit()
 
-    async def close(self):
+    async def load_states(self):
         async with self.session_maker() as session:
-            await session.close()
-        await self.engine.dispose()
+            result = await session.execute(
+                select(
+                    UpdateStateModel.id,
+                    UpdateStateModel.pts,
+                    UpdateStateModel.qts,
+                    UpdateStateModel.date,
+                    UpdateStateModel.seq
+                ).filter_by(session_name=self.name)
+            )
+            self._states = {row[0]: tuple(row) for row in result}
+
+    async def save(self):
+        await self.flush_states()
+        await self.date(int(time.time()))
+
+    async def close(self):
+        if self.state_task is not None:
+            self.state_task.cancel()
+
+            try:
+                await self.state_task
+            except asyncio.CancelledError:
+                pass
+
+            self.state_task = None
+
+        await self.flush_states()
+        self._states = None
+        self._session = None
+
+        await self.release_engine()
 
     async def delete(self):
+        # Pyrogram deletes the session after closing the storage
+        released = self.engine is None
+        self.acquire_engine()
+
         async with self.session_maker() as session:
             await session.execute(
                 delete(UpdateStateModel).where(UpdateStateModel.session_name == self.name)
@@ -160,41 +391,96 @@ class MultiPostgresStorage(Storage):
 
             await session.commit()
 
+        if released:
+            await self.release_engine()
+
     async def update_peers(self, peers: List[Tuple[int, int, str, str]]):
+        # ON CONFLICT can't touch the same row twice in one statement, the last value per id wins
+        peers = list({peer[0]: peer for peer in peers}.values())
+
+        if not peers:
+            return
+
         async with self.session_maker() as session:
-            for peer in peers:
-                stmt = select(PeerModel).filter_by(session_name=self.name, id=peer[0])
-                result = await session.execute(stmt)
-                existing_peer = result.scalar_one_or_none()
-
-                if existing_peer:
-                    existing_peer.access_hash = peer[1]
-                    existing_peer.type = peer[2]
-                    existing_peer.phone_number = peer[3]
-                else:
-                    new_peer = PeerModel(
-                        session_name=self.name,
-                        id=peer[0],
-                        access_hash=peer[1],
-                        type=peer[2],
-                        phone_number=peer[3]
-                    )
-                    session.add(new_peer)
+            if len(peers) >= self.COPY_THRESHOLD and self.engine.dialect.driver == "asyncpg":
+                await self._copy_peers(session, peers)
+            else:
+                ids, access_hashes, types, phone_numbers = zip(*peers)
+
+                # One statement with array parameters, its text doesn't depend on the batch size
+                await session.execute(
+                    text(
+                        "INSERT INTO peers (session_name, id, access_hash, type, phone_number, last_update_on) "
+                        "SELECT :session_name, unnest(CAST(:ids AS BIGINT[])), "
+                        "unnest(CAST(:access_hashes AS BIGINT[])), unnest(CAST(:types AS VARCHAR[])), "
+                        "unnest(CAST(:phone_numbers AS VARCHAR[])), extract(epoch FROM now())::bigint "
+                        f"{UPSERT_PEERS}"
+                    ),
+                    {
+                        "session_name": self.name,
+                        "ids": list(ids),
+                        "access_hashes": list(access_hashes),
+                        "types": list(types),
+                        "phone_numbers": list(phone_numbers),
+                    }
+                )
 
             await session.commit()
 
+    async def _copy_peers(self, session: AsyncSession, peers: List[Tuple[int, int, str, str]]):
+        conn = await session.connection()
+
+        await conn.execute(text(
+            "CREATE TEMP TABLE peers_import "
+            "(id BIGINT, access_hash BIGINT, type VARCHAR, phone_number VARCHAR) ON COMMIT DROP"
+        ))
+
+        raw_conn = await conn.get_raw_connection()
+        await raw_conn.driver_connection.copy_records_to_table(
+            "peers_import", records=peers, columns=["id", "access_hash", "type", "phone_number"]
+        )
+
+        await conn.execute(
+            text(
+                "INSERT INTO peers (session_name, id, access_hash, type, phone_number, last_update_on) "
+                "SELECT :session_name, id, access_hash, type, phone_number, extract(epoch FROM now())::bigint "
+                f"FROM peers_import {UPSERT_PEERS}"
+            ),
+            {"session_name": self.name}
+        )
+
     async def update_usernames(self, usernames: List[Tuple[int, List[str]]]):
+        usernames = {telegram_id: user_list for telegram_id, user_list in usernames}
+
+        if not usernames:
+            return
+
+        rows = [(telegram_id, username) for telegram_id, user_list in usernames.items() for username in user_list]
+
         async with self.session_maker() as session:
-            for telegram_id, _ in usernames:
-                await session.execute(
-                    delete(UsernameModel).where(UsernameModel.session_name == self.name,
-                                                UsernameModel.id == telegram_id)
-                )
+            ids, names = zip(*rows) if rows else ((), ())
 
-            for telegram_id, user_list in usernames:
-                for username in user_list:
-                    new_username = UsernameModel(session_name=self.name, id=telegram_id, username=username)
-                    session.add(new_username)
+            # Only rows that actually changed are deleted or inserted, in a single round trip
+            await session.execute(
+                text(
+                    "WITH new AS ("
+                    "SELECT unnest(CAST(:ids AS BIGINT[])) AS id, unnest(CAST(:usernames AS VARCHAR[])) AS username"
+                    "), deleted AS ("
+                    "DELETE FROM usernames u "
+                    "WHERE u.session_name = :session_name AND u.id = ANY(CAST(:peer_ids AS BIGINT[])) "
+                    "AND NOT EXISTS (SELECT 1 FROM new WHERE new.id = u.id AND new.username = u.username)"
+                    ") "
+                    "INSERT INTO usernames (session_name, id, username) "
+                    "SELECT :session_name, id, username FROM new "
+                    "ON CONFLICT DO NOTHING"
+                ),
+                {
+                    "session_name": self.name,
+                    "peer_ids": list(usernames),
+                    "ids": list(ids),
+                    "usernames": list(names),
+                }
+            )
 
             await session.commit()
 
@@ -243,7 +529,8 @@ class MultiPostgresStorage(Storage):
             username_alias = aliased(UsernameModel)
             r = await session.execute(
                 select(peer_alias.id, peer_alias.access_hash, peer_alias.type, peer_alias.last_update_on)
-                .join(username_alias, username_alias.id == peer_alias.id)
+                .join(username_alias, (username_alias.id == peer_alias.id)
+                      & (username_alias.session_name == peer_alias.session_name))
                 .filter(username_alias.username == username, username_alias.session_name == self.name)
                 .order_by(peer_alias.last_update_on.desc())
             )
@@ -254,41 +541,92 @@ class MultiPostgresStorage(Storage):
             peer_id, access_hash, peer_type, last_update_on = r
             return get_input_peer(peer_id, access_hash, peer_type)
 
+    async def state_worker(self):
+        while True:
+            await asyncio.sleep(self.state_flush_interval)
+
+            try:
+                await self.flush_states()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Flushing update states failed: %s", e)
+
+    async def flush_states(self):
+        if not self._pending_states:
+            return
+
+        states = self._pending_states
+        self._pending_states = {}
+
+        try:
+            async with self.session_maker() as session:
+                for id, state in states.items():
+                    await self._write_state(session, id if state is None else state)
+
+                await session.commit()
+        except BaseException:
+            # Keep the states for the next flush unless newer ones arrived meanwhile
+            for id, state in states.items():
+                self._pending_states.setdefault(id, state)
+
+            raise
+
+    async def _write_state(self, session: AsyncSession, value):
+        if isinstance(value, int):
+            await session.execute(
+                delete(UpdateStateModel)
+                .where(UpdateStateModel.session_name == self.name, UpdateStateModel.id == value)
+            )
+        else:
+            stmt = postgresql.insert(UpdateStateModel.__table__).values(
+                session_name=self.name,
+                id=value[0],
+                pts=value[1],
+                qts=value[2],
+                date=value[3],
+                seq=value[4]
+            )
+            await session.execute(stmt.on_conflict_do_update(
+                index_elements=[UpdateStateModel.session_name, UpdateStateModel.id],
+                set_={
+                    "pts": stmt.excluded.pts,
+                    "qts": stmt.excluded.qts,
+                    "date": stmt.excluded.date,
+                    "seq": stmt.excluded.seq,
+                }
+            ))
+
     async def update_state(self, value: Tuple[int, int, int, int, int] = object):
+        if self._states is not None:
+            if value == object:
+                return sorted(self._states.values(), key=lambda state: state[3])
+
+            if isinstance(value, int):
+                self._states.pop(value, None)
+                self._pending_states[value] = None
+            else:
+                self._states[value[0]] = tuple(value)
+                self._pending_states[value[0]] = tuple(value)
+
+            return
+
         async with self.session_maker() as session:
             if value == object:
                 result = await session.execute(
-                    select(UpdateStateModel).filter_by(session_name=self.name)
+                    select(
+                        UpdateStateModel.id,
+                        UpdateStateModel.pts,
+                        UpdateStateModel.qts,
+                        UpdateStateModel.date,
+                        UpdateStateModel.seq
+                    )
+                    .filter_by(session_name=self.name)
+                    .order_by(UpdateStateModel.date)
                 )
-                return result.scalars().all()
+                return [tuple(row) for row in result]
             else:
-                if isinstance(value, int):
-                    await session.execute(
-                        delete(UpdateStateModel)
-                        .where(UpdateStateModel.session_name == self.name, UpdateStateModel.id == value)
-                    )
-                else:
-                    state = await session.execute(
-                        select(UpdateStateModel).filter_by(session_name=self.name, id=value[0])
-                    )
-                    state_instance = state.scalar_one_or_none()
-
-                    if state_instance:
-                        state_instance.pts = value[1]
-                        state_instance.qts = value[2]
-                        state_instance.date = value[3]
-                        state_instance.seq = value[4]
-                    else:
-                        state_instance = UpdateStateModel(
-                            id=value[0],
-                            session_name=self.name,
-                            pts=value[1],
-                            qts=value[2],
-                            date=value[3],
-                            seq=value[4]
-                        )
-                        session.add(state_instance)
-
+                await self._write_state(session, value)
                 await session.commit()
 
     async def get_peer_by_phone_number(self, phone_number: str):
@@ -297,30 +635,63 @@ class MultiPostgresStorage(Storage):
                 select(PeerModel.id, PeerModel.access_hash, PeerModel.type)
                 .filter_by(session_name=self.name, phone_number=phone_number)
             )
-            r = r.scalar_one_or_none()
+            r = r.one_or_none()
 
             if r is None:
                 raise KeyError(f"Phone number not found: {phone_number}")
 
             return get_input_peer(r.id, r.access_hash, r.type)
 
+    async def get_peers_by_ids(self, ids: List[int]) -> Tuple[Dict[int, Any], List[int]]:
+        ids = list(dict.fromkeys(ids))
+
+        async with self.session_maker() as session:
+            r = await session.execute(
+                select(PeerModel.id, PeerModel.access_hash, PeerModel.type)
+                .filter(PeerModel.session_name == self.name,
+                        PeerModel.id == any_(bindparam("ids", ids, type_=ARRAY(BigInteger))))
+            )
+            peers = {peer_id: get_input_peer(peer_id, access_hash, peer_type) for peer_id, access_hash, peer_type in r}
+
+        return peers, [peer_id for peer_id in ids if peer_id not in peers]
+
+    async def get_peers_by_usernames(self, usernames: List[str]) -> Tuple[Dict[str, Any], List[str]]:
+        usernames = list(dict.fromkeys(usernames))
+
+        async with self.session_maker() as session:
+            r = await session.execute(
+                select(UsernameModel.username, PeerModel.id, PeerModel.access_hash, PeerModel.type)
+                .join(PeerModel, (PeerModel.id == UsernameModel.id) & (PeerModel.session_name == UsernameModel.session_name))
+                .filter(UsernameModel.session_name == self.name,
+                        UsernameModel.username == any_(bindparam("usernames", usernames, type_=ARRAY(String))))
+                .order_by(PeerModel.last_update_on.asc().nulls_first())
+            )
+
+            # Rows are ordered by date, so the most recently updated peer wins
+            peers = {
+                username: get_input_peer(peer_id, access_hash, peer_type)
+                for username, peer_id, access_hash, peer_type in r
+            }
+
+        return peers, [username for username in usernames if username not in peers]
+
     async def _get(self, attr: str):
+        if self._session is not None:
+            return self._session[attr]
+
         async with self.session_maker() as session:
             result = await session.execute(select(getattr(SessionModel, attr)).filter_by(session_name=self.name))
             return result.scalar_one_or_none()
 
     async def _set(self, attr: str, value: Any):
-        async with self.session_maker() as session:
-            session_instance = await session.execute(
-                select(SessionModel).filter_by(session_name=self.name)
-            )
-            session_instance = session_instance.scalar_one_or_none()
+        if self._batch_task is asyncio.current_task():
+            self._pending_session[attr] = value
+        else:
+            async with self._batch_lock:
+                await self._update_session({attr: value})
 
-            if session_instance:
-                setattr(session_instance, attr, value)
-                await session.commit()
-            else:
-                raise ValueError(f"Session with name {self.name} not found.")
+        if self._session is not None:
+            self._session[attr] = value
 
     async def _accessor(self, attr: str, value: Any = object):
         if value == object:
@@ -352,12 +723,8 @@ class MultiPostgresStorage(Storage):
     async def version(self, value: int = object):
         async with self.session_maker() as session:
             if value == object:
-                result = await session.execute(select(VersionModel.number))
+                result = await session.execute(select(func.max(MigrationModel.version)))
                 return result.scalar_one_or_none()
             else:
-                version_instance = await session.execute(select(VersionModel))
-                version_instance = version_instance.scalar_one_or_none()
-
-                if version_instance:
-                    version_instance.number = value
-                    await session.commit()
+                await session.merge(MigrationModel(version=value, applied_on=int(time.time())))
+                await session.commit()
@@ -0,0 +1,176 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+
+class SQLTracer:
+    PROGRESS_STEPS = 1000
+    PLAN_SHAPES = 1000
+
+    LITERALS = re.compile(
+        r"[xX]'[0-9a-fA-F]*'|'(?:[^']|'')*'|\bNULL\b|(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b"
+    )
+    LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+    ROWS = re.compile(r"(\((?:\?, \.\.\.|\?)\))(?:\s*,\s*\((?:\?, \.\.\.|\?)\))+")
+
+    def __init__(self, threshold: float, database: Optional[str] = None):
+        self.threshold = threshold
+        self.database = database
+        self.shapes = {}  # type: Dict[str, List]
+        self.plans = {}  # type: Dict[str, Optional[str]]
+
+        self._lock = threading.Lock()
+        self._finishers = []  # type: List[Callable[[], None]]
+        self._explain_conn = None  # type: Optional[sqlite3.Connection]
+
+    @classmethod
+    def shape(cls, statement: str) -> str:
+        shape = " ".join(cls.LITERALS.sub("?", statement).split())
+        shape = cls.LISTS.sub("?, ...", shape)
+
+        return cls.ROWS.sub(r"\1, ...", shape)
+
+    def callbacks(self):
+        # SQLite reports when a statement starts and calls the progress handler every PROGRESS_STEPS
+        # instructions while it runs. A statement ends at most when the next one on the same connection starts,
+        # and its duration is taken up to the last progress call.
+        current = [None, 0.0, 0.0]
+
+        def finish():
+            statement, start, last = current
+            current[0] = None
+
+            if statement is not None:
+                self.record(statement, last - start)
+
+        def trace(statement: str):
+            finish()
+
+            now = time.perf_counter()
+            current[:] = [statement, now, now]
+
+        def progress():
+            current[2] = time.perf_counter()
+
+            return 0
+
+        with self._lock:
+            self._finishers.append(finish)
+
+        return trace, progress
+
+    def attach(self, conn: sqlite3.Connection):
+        trace, progress = self.callbacks()
+
+        conn.set_trace_callback(trace)
+        conn.set_progress_handler(progress, self.PROGRESS_STEPS)
+
+    async def attach_async(self, conn):
+        # aiosqlite connections (and the storages' shared ones) run both calls on their own thread
+        trace, progress = self.callbacks()
+
+        await conn.set_trace_callback(trace)
+        await conn.set_progress_handler(progress, self.PROGRESS_STEPS)
+
+    def record(self, statement: str, duration: float):
+        shape = self.shape(statement)
+        slow = duration >= self.threshold
+
+        with self._lock:
+            stats = self.shapes.get(shape)
+
+            if stats is None:
+                stats = self.shapes[shape] = [0, 0.0, 0.0, 0]
+
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+            if slow:
+                stats[3] += 1
+
+        if slow:
+            # Only the shape is logged, the statement carries the bound values (auth keys, phone numbers, ...)
+            plan = self.explain(shape, statement)
+
+            log.warning(
+                "Slow query (%.1f ms): %s%s",
+                duration * 1000,
+                shape[:1000],
+                f"\n{plan}" if plan else "",
+            )
+
+    def explain(self, shape: str, statement: str) -> Optional[str]:
+        # The plan is read on a separate read-only connection, the traced one is busy running the statement
+        if self.database is None:
+            return None
+
+        with self._lock:
+            if shape in self.plans:
+                return self.plans[shape]
+
+            plan = None
+
+            try:
+                if self._explain_conn is None:
+                    self._explain_conn = sqlite3.connect(
+                        f"{Path(self.database).resolve().as_uri()}?mode=ro",
+                        uri=True,
+                        timeout=0,
+                        check_same_thread=False,
+                    )
+
+                rows = self._explain_conn.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()
+                depth = {0: -1}
+
+                for id, parent, _, detail in rows:
+                    depth[id] = depth.get(parent, -1) + 1
+
+                plan = "\n".join("  " * depth[id] + detail for id, _, _, detail in rows) or None
+            except sqlite3.Error:
+                pass
+
+            if len(self.plans) < self.PLAN_SHAPES:
+                self.plans[shape] = plan
+
+            return plan
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            shapes = sorted(self.shapes.items(), key=lambda item: item[1][1], reverse=True)
+
+            return [
+                {
+                    "statement": shape,
+                    "count": count,
+                    "total": total,
+                    "max": maximum,
+                    "slow": slow,
+                    "plan": self.plans.get(shape),
+                }
+                for shape, (count, total, maximum, slow) in shapes
+            ]
+
+    def reset(self):
+        with self._lock:
+            self.shapes.clear()
+            self.plans.clear()
+
+    def close(self):
+        with self._lock:
+            finishers = self._finishers
+            self._finishers = []
+
+        for finish in finishers:
+            finish()
+
+        with self._lock:
+            if self._explain_conn is not None:
+                self._explain_conn.close()
+                self._explain_conn = None
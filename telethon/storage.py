@@ -2,13 +2,16 @@ import sqlite3
 import logging
 import os
 import time
-from typing import Any, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 from pyrogram import Client, raw, utils
 from pyrogram.storage import Storage
 
 log = logging.getLogger(__name__)
 
+# SQLite binds up to 32766 parameters per statement since 3.32.0, and 999 before
+MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
 # language=SQLite
 SCHEMA = """
 CREATE TABLE sessions
@@ -81,8 +84,9 @@ class TelethonStorage(Storage):
     VERSION = 7
     USERNAME_TTL = 8 * 60 * 60
     FILE_EXTENSION = ".session"
+    QUERY_CHUNK_SIZE = MAX_VARIABLES
 
-    def __init__(self, *, client: Client):
+    def __init__(self, *, client: Client, trace_threshold: Optional[float] = None):
         super().__init__(client.name)
 
         self._api_id = client.api_id
@@ -91,6 +95,14 @@ class TelethonStorage(Storage):
 
         self.database = client.workdir / (client.name + self.FILE_EXTENSION)
 
+        self.tracer = None  # type: Optional["SQLTracer"]
+
+        if trace_threshold is not None:
+            # sqltrace.py has to be copied next to this file, see sqltrace/README.md
+            from sqltrace import SQLTracer
+
+            self.tracer = SQLTracer(trace_threshold, str(self.database))
+
     async def create(self):
         with self.conn:
             self.conn.executescript(SCHEMA)
@@ -167,6 +179,9 @@ class TelethonStorage(Storage):
 
         self.conn = sqlite3.connect(str(path), timeout=1, check_same_thread=False)
 
+        if self.tracer is not None:
+            self.tracer.attach(self.conn)
+
         if not file_exists:
             await self.create()
         else:
@@ -182,6 +197,9 @@ class TelethonStorage(Storage):
     async def close(self):
         self.conn.close()
 
+        if self.tracer is not None:
+            self.tracer.close()
+
     async def delete(self):
         os.remove(self.database)
 
@@ -260,6 +278,46 @@ class TelethonStorage(Storage):
 
         return get_input_peer(*r)
 
+    async def get_peers_by_ids(self, ids: List[int]) -> Tuple[Dict[int, Any], List[int]]:
+        ids = list(dict.fromkeys(ids))
+        peers = {}
+
+        for i in range(0, len(ids), self.QUERY_CHUNK_SIZE):
+            chunk = ids[i:i + self.QUERY_CHUNK_SIZE]
+
+            rows = self.conn.execute(
+                f"SELECT id, hash FROM entities WHERE id IN ({', '.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+
+            for r in rows:
+                peers[r[0]] = get_input_peer(*r)
+
+        return peers, [peer_id for peer_id in ids if peer_id not in peers]
+
+    async def get_peers_by_usernames(self, usernames: List[str]) -> Tuple[Dict[str, Any], List[str]]:
+        usernames = list(dict.fromkeys(usernames))
+        peers = {}
+
+        for i in range(0, len(usernames), self.QUERY_CHUNK_SIZE):
+            chunk = usernames[i:i + self.QUERY_CHUNK_SIZE]
+
+            rows = self.conn.execute(
+                "SELECT username, id, hash, date FROM entities "
+                f"WHERE username IN ({', '.join('?' * len(chunk))}) "
+                "ORDER BY date ASC",
+                chunk
+            ).fetchall()
+
+            # Rows are ordered by date, so the most recently updated entity wins
+            latest = {r[0]: r[1:] for r in rows}
+
+            for username, r in latest.items():
+                if abs(time.time() - r[2]) <= self.USERNAME_TTL:
+                    peers[username] = get_input_peer(*r[:2])
+
+        return peers, [username for username in usernames if username not in peers]
+
     async def _get(self, table: str, attr: str):
         return self.conn.execute(f"SELECT {attr} FROM {table}").fetchone()[0]
 
@@ -0,0 +1,206 @@
+import asyncio
+import base64
+import struct
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from pyrogram import raw
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmark.backends import load_storage_module, make_client  # noqa: E402
+
+# MemoryStorage has to behave like the SQLite backend, so every case runs against both
+BACKENDS = ["memory", "aiosqlite"]
+
+
+def make_storage(backend: str, tmp_path: Path, session_string: str = None):
+    client = make_client("parity", tmp_path)
+    client.in_memory = True
+    client.session_string = session_string
+
+    if backend == "memory":
+        return load_storage_module("memory").MemoryStorage(client)
+
+    return load_storage_module("aiosqlite").AIOSQLiteStorage(client)
+
+
+def run(backend: str, tmp_path: Path, scenario, session_string: str = None):
+    async def main():
+        storage = make_storage(backend, tmp_path, session_string)
+        await storage.open()
+
+        try:
+            return await scenario(storage)
+        finally:
+            await storage.close()
+
+    return asyncio.run(main())
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    return request.param
+
+
+def test_new_session(backend, tmp_path):
+    async def scenario(storage):
+        return (
+            await storage.dc_id(),
+            await storage.server_address(),
+            await storage.port(),
+            await storage.api_id(),
+            await storage.auth_key(),
+            await storage.date(),
+            await storage.user_id(),
+        )
+
+    assert run(backend, tmp_path, scenario) == (2, "149.154.167.51", 443, None, None, 0, None)
+
+
+def test_session_string(backend, tmp_path):
+    session_string = base64.urlsafe_b64encode(
+        struct.pack(">BI?256sQ?", 4, 12345, False, b"k" * 256, 777, True)
+    ).decode().rstrip("=")
+
+    async def scenario(storage):
+        return (
+            await storage.export_session_string(),
+            await storage.dc_id(),
+            await storage.server_address(),
+            await storage.user_id(),
+            await storage.is_bot(),
+        )
+
+    assert run(backend, tmp_path, scenario, session_string) == (session_string, 4, "149.154.167.91", 777, True)
+
+
+def test_get_peer_by_id(backend, tmp_path):
+    async def scenario(storage):
+        await storage.update_peers([
+            (1, 11, "user", None),
+            (2, 22, "bot", None),
+            (-3, 0, "group", None),
+            (-1000000000004, 44, "channel", None),
+        ])
+
+        with pytest.raises(KeyError):
+            await storage.get_peer_by_id(5)
+
+        return [await storage.get_peer_by_id(peer_id) for peer_id in (1, 2, -3, -1000000000004)]
+
+    assert run(backend, tmp_path, scenario) == [
+        raw.types.InputPeerUser(user_id=1, access_hash=11),
+        raw.types.InputPeerUser(user_id=2, access_hash=22),
+        raw.types.InputPeerChat(chat_id=3),
+        raw.types.InputPeerChannel(channel_id=4, access_hash=44),
+    ]
+
+
+def test_phone_number_replaced(backend, tmp_path):
+    async def scenario(storage):
+        await storage.update_peers([(1, 11, "user", "111")])
+        await storage.update_peers([(1, 12, "user", "222")])
+
+        with pytest.raises(KeyError):
+            await storage.get_peer_by_phone_number("111")
+
+        return await storage.get_peer_by_phone_number("222")
+
+    assert run(backend, tmp_path, scenario) == raw.types.InputPeerUser(user_id=1, access_hash=12)
+
+
+def test_usernames_replaced(backend, tmp_path):
+    async def scenario(storage):
+        await storage.update_peers([(1, 11, "user", None)])
+        await storage.update_usernames([(1, ["old", "kept"])])
+        await storage.update_usernames([(1, ["kept", "new"])])
+
+        with pytest.raises(KeyError):
+            await storage.get_peer_by_username("old")
+
+        return await storage.get_peer_by_username("kept"), await storage.get_peer_by_username("new")
+
+    peer = raw.types.InputPeerUser(user_id=1, access_hash=11)
+
+    assert run(backend, tmp_path, scenario) == (peer, peer)
+
+
+def test_username_expired(backend, tmp_path):
+    async def scenario(storage):
+        storage.USERNAME_TTL = -1
+
+        await storage.update_peers([(1, 11, "user", None)])
+        await storage.update_usernames([(1, ["name"])])
+
+        with pytest.raises(KeyError):
+            await storage.get_peer_by_username("name")
+
+        return await storage.get_peers_by_usernames(["name"])
+
+    assert run(backend, tmp_path, scenario) == ({}, ["name"])
+
+
+def test_username_moved(backend, tmp_path):
+    # last_update_on has a resolution of one second
+    async def scenario(storage):
+        await storage.update_peers([(1, 11, "user", None), (2, 22, "user", None)])
+        await storage.update_usernames([(1, ["name"])])
+
+        time.sleep(1.1)
+
+        await storage.update_peers([(2, 22, "user", None)])
+        await storage.update_usernames([(2, ["name"])])
+
+        moved = await storage.get_peer_by_username("name")
+
+        time.sleep(1.1)
+
+        # Peer 1 still has the username until its own usernames are updated, and it is the newest now
+        await storage.update_peers([(1, 11, "user", None)])
+
+        seen_again = await storage.get_peer_by_username("name")
+
+        await storage.update_usernames([(1, [])])
+
+        return moved, seen_again, await storage.get_peers_by_usernames(["name"])
+
+    assert run(backend, tmp_path, scenario) == (
+        raw.types.InputPeerUser(user_id=2, access_hash=22),
+        raw.types.InputPeerUser(user_id=1, access_hash=11),
+        ({"name": raw.types.InputPeerUser(user_id=2, access_hash=22)}, []),
+    )
+
+
+def test_bulk_lookups(backend, tmp_path):
+    async def scenario(storage):
+        await storage.update_peers([(1, 11, "user", None), (2, 22, "user", None)])
+        await storage.update_usernames([(1, ["one"]), (2, ["two"])])
+
+        return (
+            await storage.get_peers_by_ids([2, 3, 1, 2]),
+            await storage.get_peers_by_usernames(["two", "three", "one", "two"]),
+        )
+
+    one = raw.types.InputPeerUser(user_id=1, access_hash=11)
+    two = raw.types.InputPeerUser(user_id=2, access_hash=22)
+
+    assert run(backend, tmp_path, scenario) == (
+        ({1: one, 2: two}, [3]),
+        ({"one": one, "two": two}, ["three"]),
+    )
+
+
+def test_update_state(backend, tmp_path):
+    async def scenario(storage):
+        await storage.update_state((1, 10, 0, 300, 0))
+        await storage.update_state((2, 20, 0, 100, 0))
+        await storage.update_state((3, 30, 0, 200, 0))
+        await storage.update_state((1, 11, 0, 50, 0))
+        await storage.update_state(3)
+
+        return [tuple(state) for state in await storage.update_state()]
+
+    assert run(backend, tmp_path, scenario) == [(1, 11, 0, 50, 0), (2, 20, 0, 100, 0)]